@@ -0,0 +1,218 @@
+"""Batch mode: apply one set of filter settings to a folder of images.
+
+    python main.py batch --params settings.json --in DIR --out DIR [--jobs N]
+
+settings.json is a JSON object of FilterParams fields, for example
+{"contrast": 1.4, "sharpen": 2, "invert": true}; anything left out keeps
+its neutral default. Each image is written to the output folder under the
+same name. A file that fails to load, render or save is reported and
+skipped without stopping the rest of the batch.
+
+By default every file is handled start to finish by one of --jobs worker
+processes. With --pipeline, decoding, filtering and encoding run as three
+stages of threads instead (see Pipeline), each with its own worker count,
+so disk and codec waits overlap with the filter work.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import fields
+from engine import FilterParams, open_rgb, render
+import argparse
+import json
+import math
+import os
+import queue
+import sys
+import threading
+import time
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+
+
+def _setting(field, value):
+    # The value converted to the field's type, or None if it isn't one; JSON
+    # has no separate int, so 3.0 is fine for an int but 2.5 isn't, and
+    # strings and numbers are never taken for true or false
+    if field.type is bool:
+        return value if isinstance(value, bool) else None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        return None
+    if field.type is int:
+        return int(value) if value == int(value) else None
+    return float(value)
+
+
+def load_params(path):
+    """FilterParams from a settings file; unknown keys and mistyped values are an error"""
+    with open(path) as f:
+        settings = json.load(f)
+    if not isinstance(settings, dict):
+        raise ValueError(f"{path} should hold a JSON object of settings")
+    known = {field.name: field for field in fields(FilterParams)}
+    unknown = sorted(set(settings) - set(known))
+    if unknown:
+        raise ValueError(f"Unknown settings in {path}: {', '.join(unknown)}")
+    params = {}
+    for name, value in settings.items():
+        params[name] = _setting(known[name], value)
+        if params[name] is None:
+            kind = {bool: "true or false", int: "a whole number"}.get(known[name].type, "a number")
+            raise ValueError(f"{name} in {path} should be {kind}, not {json.dumps(value)}")
+    return FilterParams(**params)
+
+
+def process_file(src, dst, params):
+    """Render one file (in a worker process); returns its size in megapixels"""
+    im = open_rgb(src)
+    render(im, params, fuse=True, lut=True).save(dst)
+    return im.width * im.height / 1e6
+
+
+def run_pool(in_dir, out_dir, names, params, jobs):
+    """Yield (name, megapixels, error) as each file is finished"""
+    with ProcessPoolExecutor(max(1, jobs)) as pool:
+        futures = {pool.submit(process_file, os.path.join(in_dir, name),
+                               os.path.join(out_dir, name), params): name
+                   for name in names}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], 0, e
+
+
+_DONE = object()
+
+
+class _Stage:
+    def __init__(self, function, workers):
+        self.function = function
+        self.workers = max(1, workers)
+        self.running = self.workers
+        self.lock = threading.Lock()
+
+    def work(self, inbox, outbox, successors):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            name, value, error = item
+            if error is None:
+                try:
+                    value = self.function(name, value)
+                except Exception as e:
+                    value, error = None, e
+            outbox.put((name, value, error))
+        # The last worker out tells every worker of the next stage to stop
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            for _ in range(successors):
+                outbox.put(_DONE)
+
+
+class Pipeline:
+    """Stages of worker threads connected by bounded queues.
+
+    Each stage is a (function, workers) pair; function(name, value) gets
+    what the previous stage returned for that name. The queue in front of
+    a stage holds at most one item per worker, so a slow stage holds back
+    the ones before it instead of letting decoded images pile up, and
+    throughput is set by the slowest stage rather than the sum. An
+    exception skips the rest of that item's stages and is reported with it.
+    """
+    def __init__(self, stages):
+        self.stages = [_Stage(function, workers) for function, workers in stages]
+
+    def run(self, names):
+        """Yield (name, result, error) for each name as it leaves the last stage"""
+        queues = [queue.Queue()]
+        queues += [queue.Queue(maxsize=stage.workers) for stage in self.stages[1:]]
+        queues.append(queue.Queue())
+        for i, stage in enumerate(self.stages):
+            successors = self.stages[i + 1].workers if i + 1 < len(self.stages) else 1
+            for _ in range(stage.workers):
+                threading.Thread(target=stage.work, args=(queues[i], queues[i + 1], successors),
+                                 daemon=True).start()
+
+        for name in names:
+            queues[0].put((name, None, None))
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_DONE)
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            yield item
+
+
+def run_pipeline(in_dir, out_dir, names, params, decode_jobs, jobs, encode_jobs):
+    """Yield (name, megapixels, error) as each file is finished"""
+    def decode(name, _):
+        return open_rgb(os.path.join(in_dir, name))
+
+    def process(name, im):
+        return render(im, params, fuse=True, lut=True), im.width * im.height / 1e6
+
+    def encode(name, result):
+        im, megapixels = result
+        im.save(os.path.join(out_dir, name))
+        return megapixels
+
+    stages = [(decode, decode_jobs), (process, jobs), (encode, encode_jobs)]
+    for name, megapixels, error in Pipeline(stages).run(names):
+        yield name, megapixels or 0, error
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="main.py batch",
+                                     description="Apply filter settings to every image in a folder.")
+    parser.add_argument("--params", required=True, help="JSON file of filter settings")
+    parser.add_argument("--in", dest="in_dir", required=True, help="folder of source images")
+    parser.add_argument("--out", dest="out_dir", required=True, help="folder to write results to")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="worker processes, or filter threads with --pipeline "
+                             "(default: one per CPU)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="run decode, filter and encode as separate threaded stages")
+    parser.add_argument("--decode-jobs", type=int, default=2,
+                        help="decoder threads with --pipeline (default: 2)")
+    parser.add_argument("--encode-jobs", type=int, default=2,
+                        help="encoder threads with --pipeline (default: 2)")
+    args = parser.parse_args(argv)
+
+    try:
+        params = load_params(args.params)
+    except (OSError, ValueError, TypeError) as e:
+        parser.error(f"Can't read settings: {e}")
+    if not os.path.isdir(args.in_dir):
+        parser.error(f"--in {args.in_dir} is not a folder")
+    if os.path.abspath(args.in_dir) == os.path.abspath(args.out_dir):
+        parser.error("--out must be a different folder from --in")
+    names = sorted(name for name in os.listdir(args.in_dir)
+                   if name.lower().endswith(IMAGE_EXTENSIONS))
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    total = len(names)
+    failed = 0
+    megapixels = 0.0
+    start = time.perf_counter()
+    if args.pipeline:
+        results = run_pipeline(args.in_dir, args.out_dir, names, params,
+                               args.decode_jobs, args.jobs, args.encode_jobs)
+    else:
+        results = run_pool(args.in_dir, args.out_dir, names, params, args.jobs)
+    for done, (name, size, error) in enumerate(results, 1):
+        if error is None:
+            megapixels += size
+            print(f"[{done}/{total}] {name}", flush=True)
+        else:
+            failed += 1
+            print(f"[{done}/{total}] {name}: FAILED ({error})", file=sys.stderr, flush=True)
+    elapsed = max(time.perf_counter() - start, 1e-6)
+
+    ok = total - failed
+    print(f"Processed {ok}/{total} images ({megapixels:.1f} MP) in {elapsed:.1f} s: "
+          f"{ok / elapsed:.1f} images/s, {megapixels / elapsed:.1f} MP/s"
+          + (f", {failed} failed" if failed else ""))
+    return 1 if failed else 0
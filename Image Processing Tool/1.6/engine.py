@@ -0,0 +1,1078 @@
+"""Headless filter engine for the Image Processing Tool.
+
+The GUI snapshots its slider values into a FilterParams and hands it to
+render(); nothing in here touches Tk, so the same chain can run in worker
+threads, subprocesses or on a machine without a display.
+"""
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from PIL import Image, ImageFilter, ImageEnhance, ImageOps, ImageStat
+import math
+import numpy as np
+import threading
+import weakref
+
+
+@dataclass(frozen=True)
+class FilterParams:
+    """Immutable snapshot of every filter setting (defaults = no-op)"""
+    grayscale: float = 0
+    blur: float = 0
+    contrast: float = 1
+    brightness: float = 1
+    sharpen: float = 0
+    saturation: float = 1
+    edge_enhance: float = 0
+    rotation: float = 0
+    sepia: float = 0
+    posterize: int = 8
+    emboss_intensity: int = 0
+    hue_shift: int = 0
+    noise_reduction_size: int = 1
+    invert: bool = False
+    flip_horizontal: bool = False
+    flip_vertical: bool = False
+    auto_contrast: bool = False
+
+
+def apply_sepia(img):
+    arr = np.array(img).astype(np.float32)
+    r, g, b = arr[:,:,0], arr[:,:,1], arr[:,:,2]
+    tr = 0.393 * r + 0.769 * g + 0.189 * b
+    tg = 0.349 * r + 0.686 * g + 0.168 * b
+    tb = 0.272 * r + 0.534 * g + 0.131 * b
+    sepia_arr = np.stack([tr, tg, tb], axis=2)
+    sepia_arr = np.clip(sepia_arr, 0, 255).astype(np.uint8)
+    return Image.fromarray(sepia_arr)
+
+
+def shift_hue(img, hue_shift):
+    """Shift hue by given degrees"""
+    hsv = img.convert('HSV')
+    np_hsv = np.array(hsv)
+    # hue_shift expected in degrees, convert to 0-255 range
+    shift = int((hue_shift / 360.0) * 255)
+    np_hsv[...,0] = ((np_hsv[...,0].astype(np.int16) + shift) % 256).astype(np.uint8)
+    shifted = Image.fromarray(np_hsv, 'HSV').convert('RGB')
+    return shifted
+
+
+def median_size(size):
+    """Median filter window for a noise reduction setting (0 = off)"""
+    if size <= 1:
+        return 0
+    if size % 2 == 0:
+        size += 1  # Make it odd
+    return max(size, 3)  # Ensure at least 3
+
+
+class Stage:
+    """One step of the filter chain.
+
+    `fields` names the FilterParams attributes the stage reads; together with
+    the stage name they form the stage's cache key. Pointwise stages also
+    carry a `kernel` that does the same thing to a float32 strip in place
+    (see FusedStage), `per_channel` marks the ones whose output channel only
+    depends on the same input channel (see ToneCurve), and stages that
+    depend on a whole-image statistic provide `measure` to compute it and
+    are applied as apply(im, params, stat). Neighbourhood stages report how
+    many pixels of context they read (`halo`) and, where their size is a
+    parameter, how to `rescale` it for an image scaled by a factor (see
+    plan_region). Stages that move pixels around set tileable=False.
+    """
+    def __init__(self, name, fields, active, apply, kernel=None, measure=None,
+                 per_channel=False, halo=None, rescale=None, tileable=True):
+        self.name = name
+        self.fields = fields
+        self.active = active
+        self.apply = apply
+        self.kernel = kernel
+        self.measure = measure
+        self.per_channel = per_channel
+        self.halo = halo
+        self.rescale = rescale
+        self.tileable = tileable
+
+    def key(self, params):
+        return (self.name,) + tuple(getattr(params, f) for f in self.fields)
+
+
+def _rotation_matrix(size, angle):
+    """Pillow's rotate(angle, expand=True) as (inverse affine matrix, output size)"""
+    w, h = size
+    angle = angle % 360.0
+    # Pillow transposes right angles instead of resampling
+    if angle == 0:
+        return (1.0, 0.0, 0.0, 0.0, 1.0, 0.0), (w, h)
+    if angle == 90:
+        return (0.0, -1.0, float(w), 1.0, 0.0, 0.0), (h, w)
+    if angle == 180:
+        return (-1.0, 0.0, float(w), 0.0, -1.0, float(h)), (w, h)
+    if angle == 270:
+        return (0.0, 1.0, 0.0, -1.0, 0.0, float(h)), (h, w)
+
+    angle = -math.radians(angle)
+    matrix = [
+        round(math.cos(angle), 15),
+        round(math.sin(angle), 15),
+        0.0,
+        round(-math.sin(angle), 15),
+        round(math.cos(angle), 15),
+        0.0,
+    ]
+
+    def transform(x, y):
+        a, b, c, d, e, f = matrix
+        return a * x + b * y + c, d * x + e * y + f
+
+    matrix[2], matrix[5] = transform(-w / 2, -h / 2)
+    matrix[2] += w / 2
+    matrix[5] += h / 2
+    xx, yy = zip(*(transform(x, y) for x, y in ((0, 0), (w, 0), (w, h), (0, h))))
+    nw = math.ceil(max(xx)) - math.floor(min(xx))
+    nh = math.ceil(max(yy)) - math.floor(min(yy))
+    matrix[2], matrix[5] = transform(-(nw - w) / 2.0, -(nh - h) / 2.0)
+    return tuple(matrix), (nw, nh)
+
+
+# Rotation (Pillow's counter-clockwise angle) followed by flips, as the one
+# transpose that does the same thing
+_TRANSPOSES = {
+    (0, False, True): Image.Transpose.FLIP_TOP_BOTTOM,
+    (0, True, False): Image.Transpose.FLIP_LEFT_RIGHT,
+    (0, True, True): Image.Transpose.ROTATE_180,
+    (90, False, False): Image.Transpose.ROTATE_90,
+    (90, False, True): Image.Transpose.TRANSPOSE,
+    (90, True, False): Image.Transpose.TRANSVERSE,
+    (90, True, True): Image.Transpose.ROTATE_270,
+    (180, False, False): Image.Transpose.ROTATE_180,
+    (180, False, True): Image.Transpose.FLIP_LEFT_RIGHT,
+    (180, True, False): Image.Transpose.FLIP_TOP_BOTTOM,
+    (270, False, False): Image.Transpose.ROTATE_270,
+    (270, False, True): Image.Transpose.TRANSVERSE,
+    (270, True, False): Image.Transpose.TRANSPOSE,
+    (270, True, True): Image.Transpose.ROTATE_90,
+}
+
+
+def _geometry_matrix(size, params):
+    """Rotation plus flips as (inverse affine matrix, output size)"""
+    (a, b, c, d, e, f), (w, h) = _rotation_matrix(size, -params.rotation)
+    if params.flip_horizontal:
+        a, c, d, f = -a, a * w + c, -d, d * w + f
+    if params.flip_vertical:
+        b, c, e, f = -b, b * h + c, -e, e * h + f
+    return (a, b, c, d, e, f), (w, h)
+
+
+def _geometry(im, params):
+    # One lossless transpose for right angles, otherwise one resampling pass
+    # for the rotation and a transpose for the flips. Folding the flips into
+    # the affine matrix rounds differently and isn't bit-identical to
+    # rotate() followed by transposes.
+    angle = -params.rotation % 360.0
+    if angle in (0, 90, 180, 270):
+        op = _TRANSPOSES.get((int(angle), params.flip_horizontal, params.flip_vertical))
+        return im.transpose(op) if op is not None else im
+    matrix, size = _rotation_matrix(im.size, angle)
+    im = im.transform(size, Image.Transform.AFFINE, matrix, Image.Resampling.BICUBIC)
+    op = _TRANSPOSES.get((0, params.flip_horizontal, params.flip_vertical))
+    return im.transpose(op) if op is not None else im
+
+
+def _grayscale(im, params):
+    gs = im.convert("L").convert("RGB")
+    return Image.blend(im, gs, params.grayscale)
+
+
+def _blur(im, params):
+    return im.filter(ImageFilter.GaussianBlur(radius=params.blur))
+
+
+def _contrast(im, params, stat):
+    # ImageEnhance.Contrast, with the mean luma passed in
+    degenerate = Image.new("L", im.size, stat).convert(im.mode)
+    return Image.blend(degenerate, im, params.contrast)
+
+
+def _brightness(im, params):
+    return ImageEnhance.Brightness(im).enhance(params.brightness)
+
+
+def _sharpen(im, params):
+    return ImageEnhance.Sharpness(im).enhance(params.sharpen)
+
+
+def _saturation(im, params):
+    return ImageEnhance.Color(im).enhance(params.saturation)
+
+
+def _edge_enhance(im, params):
+    im = im.filter(ImageFilter.EDGE_ENHANCE)
+    if params.edge_enhance > 1:
+        im = ImageEnhance.Sharpness(im).enhance(params.edge_enhance / 2)
+    return im
+
+
+def _sepia(im, params):
+    sepia = apply_sepia(im)
+    return Image.blend(im, sepia, params.sepia)
+
+
+def _posterize(im, params):
+    return ImageOps.posterize(im, params.posterize)
+
+
+def _emboss(im, params):
+    # Flips now happen before this stage, so mirror the (asymmetric) kernel
+    # to get the same result as embossing first and flipping afterwards
+    size, scale, offset, kernel = ImageFilter.EMBOSS.filterargs
+    kernel = np.reshape(kernel, size)
+    if params.flip_horizontal:
+        kernel = kernel[:, ::-1]
+    if params.flip_vertical:
+        kernel = kernel[::-1, :]
+    im = im.filter(ImageFilter.Kernel(size, kernel.ravel().tolist(), scale, offset))
+    if params.emboss_intensity > 1:
+        im = ImageEnhance.Sharpness(im).enhance(params.emboss_intensity / 2)
+    return im
+
+
+def _hue_shift(im, params):
+    return shift_hue(im, params.hue_shift)
+
+
+def _noise_reduction(im, params):
+    return im.filter(ImageFilter.MedianFilter(size=median_size(params.noise_reduction_size)))
+
+
+def _invert(im, params):
+    return ImageOps.invert(im)
+
+
+def _auto_contrast(im, params, stat):
+    # ImageOps.autocontrast (no cutoff), with each band's (min, max) passed in
+    lut = []
+    for lo, hi in stat:
+        if hi <= lo:
+            lut.extend(range(256))
+        else:
+            scale = 255.0 / (hi - lo)
+            offset = -lo * scale
+            lut.extend(min(255, max(0, int(ix * scale + offset))) for ix in range(256))
+    return im.point(lut)
+
+
+def _extrema(im):
+    return tuple(im.getextrema())
+
+
+# Pointwise kernels. Each works in place on a float32 (rows, width, 3) strip
+# holding uint8 values and reproduces Pillow's arithmetic exactly: blends are
+# float32 `in1 + alpha * (in2 - in1)` clipped and truncated, and luma uses
+# the same 16-bit fixed-point weights as convert("L").
+
+def _luma(x):
+    # Every term stays below 2**24, so this is exact in float32
+    l = x[..., 0:1] * 19595
+    l += x[..., 1:2] * 38470
+    l += x[..., 2:3] * 7471
+    l += 0x8000
+    l *= 1.0 / 65536
+    return np.floor(l, out=l)
+
+
+def _blend(out, in1, in2, alpha):
+    t = in2 - in1
+    t *= np.float32(alpha)
+    t += in1
+    np.maximum(t, 0, out=t)
+    np.minimum(t, 255, out=t)
+    np.trunc(t, out=out)
+
+
+def _luma_mean(im):
+    # Same rounding as ImageEnhance.Contrast
+    return int(ImageStat.Stat(im.convert("L")).mean[0] + 0.5)
+
+
+def _grayscale_kernel(x, params, stat):
+    _blend(x, x, _luma(x), params.grayscale)
+
+
+def _contrast_kernel(x, params, stat):
+    _blend(x, np.float32(stat), x, params.contrast)
+
+
+def _brightness_kernel(x, params, stat):
+    _blend(x, np.float32(0), x, params.brightness)
+
+
+def _saturation_kernel(x, params, stat):
+    _blend(x, _luma(x), x, params.saturation)
+
+
+def _sepia_kernel(x, params, stat):
+    r, g, b = x[..., 0], x[..., 1], x[..., 2]
+    sepia = np.empty_like(x)
+    sepia[..., 0] = 0.393 * r + 0.769 * g + 0.189 * b
+    sepia[..., 1] = 0.349 * r + 0.686 * g + 0.168 * b
+    sepia[..., 2] = 0.272 * r + 0.534 * g + 0.131 * b
+    np.clip(sepia, 0, 255, out=sepia)
+    np.trunc(sepia, out=sepia)
+    _blend(x, x, sepia, params.sepia)
+
+
+def _posterize_kernel(x, params, stat):
+    step = 1 << (8 - params.posterize)
+    x *= 1.0 / step
+    np.floor(x, out=x)
+    x *= step
+
+
+def _hue_shift_kernel(x, params, stat):
+    # The HSV round trip is Pillow's own, run on just this strip
+    shifted = shift_hue(Image.fromarray(x.astype(np.uint8)), params.hue_shift)
+    x[...] = np.asarray(shifted)
+
+
+def _invert_kernel(x, params, stat):
+    np.subtract(255, x, out=x)
+
+
+def _blur_halo(params):
+    # GaussianBlur is three box blurs, each reaching at most radius + 2 pixels
+    return 3 * (int(params.blur) + 2)
+
+
+def _noise_reduction_rescale(params, scale):
+    # Any window that rounds below 3 turns the filter off (see median_size)
+    return {"noise_reduction_size": int(round(median_size(params.noise_reduction_size) * scale))}
+
+
+# The chain in the order the GUI has always applied it, except that the flips
+# are folded into the rotation at the start (every stage in between is
+# symmetric or, like emboss, mirrors itself to match)
+STAGES = (
+    Stage("geometry", ("rotation", "flip_horizontal", "flip_vertical"),
+          lambda p: p.rotation != 0 or p.flip_horizontal or p.flip_vertical, _geometry,
+          tileable=False),
+    Stage("grayscale", ("grayscale",), lambda p: p.grayscale > 0, _grayscale,
+          kernel=_grayscale_kernel),
+    Stage("blur", ("blur",), lambda p: p.blur > 0, _blur, halo=_blur_halo,
+          rescale=lambda p, s: {"blur": p.blur * s}),
+    Stage("contrast", ("contrast",), lambda p: p.contrast != 1, _contrast,
+          kernel=_contrast_kernel, measure=_luma_mean, per_channel=True),
+    Stage("brightness", ("brightness",), lambda p: p.brightness != 1, _brightness,
+          kernel=_brightness_kernel, per_channel=True),
+    Stage("sharpen", ("sharpen",), lambda p: p.sharpen > 0, _sharpen, halo=lambda p: 1),
+    Stage("saturation", ("saturation",), lambda p: p.saturation != 1, _saturation,
+          kernel=_saturation_kernel),
+    Stage("edge_enhance", ("edge_enhance",), lambda p: p.edge_enhance > 0, _edge_enhance,
+          halo=lambda p: 2),
+    Stage("sepia", ("sepia",), lambda p: p.sepia > 0, _sepia, kernel=_sepia_kernel),
+    Stage("posterize", ("posterize",), lambda p: p.posterize < 8, _posterize,
+          kernel=_posterize_kernel, per_channel=True),
+    Stage("emboss", ("emboss_intensity", "flip_horizontal", "flip_vertical"),
+          lambda p: p.emboss_intensity > 0, _emboss, halo=lambda p: 2),
+    Stage("hue_shift", ("hue_shift",), lambda p: p.hue_shift != 0, _hue_shift,
+          kernel=_hue_shift_kernel),
+    Stage("noise_reduction", ("noise_reduction_size",),
+          lambda p: median_size(p.noise_reduction_size) > 0, _noise_reduction,
+          halo=lambda p: median_size(p.noise_reduction_size) // 2,
+          rescale=_noise_reduction_rescale),
+    Stage("invert", ("invert",), lambda p: p.invert, _invert, kernel=_invert_kernel,
+          per_channel=True),
+    Stage("auto_contrast", ("auto_contrast",), lambda p: p.auto_contrast, _auto_contrast,
+          measure=_extrema),
+)
+
+
+# Pixels per strip in FusedStage; small enough to stay in cache as float32
+STRIP_PIXELS = 1 << 16
+
+
+class FusedStage:
+    """A run of consecutive pointwise stages evaluated in one pass.
+
+    The image is streamed through in strips of rows: each strip is converted
+    to float32 once, run through every member kernel and pasted into the
+    single output image, instead of every stage allocating and writing a
+    full-size intermediate. Only the first member may need a whole-image
+    statistic, since it is measured on the run's input.
+    """
+    name = "fused"
+    halo = None
+    tileable = True
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.measure = stages[0].measure
+
+    def key(self, params):
+        return (self.name,) + tuple(stage.key(params) for stage in self.stages)
+
+    def apply(self, im, params, stat=None):
+        if stat is None and self.measure:
+            stat = self.measure(im)
+        # Tone curves at either end of the run are applied to the uint8
+        # strip with Image.point, which is cheaper than a float32 lookup
+        members = list(self.stages)
+        head = members.pop(0).lut(params, stat) if isinstance(members[0], ToneCurve) else None
+        tail = members.pop().lut(params, stat) if isinstance(members[-1], ToneCurve) else None
+        w, h = im.size
+        out = Image.new("RGB", im.size)
+        rows = max(1, STRIP_PIXELS // w)
+        for top in range(0, h, rows):
+            box = (0, top, w, min(h, top + rows))
+            strip = im.crop(box)
+            if head is not None:
+                strip = strip.point(head)
+            x = np.asarray(strip, dtype=np.float32)
+            for stage in members:
+                stage.kernel(x, params, stat)
+            strip = Image.fromarray(x.astype(np.uint8))
+            if tail is not None:
+                strip = strip.point(tail)
+            out.paste(strip, box[:2])
+        return out
+
+
+# Compiled lookup tables, keyed by step key and statistic. plan() builds new
+# step objects on every render, so the tables are memoised here instead.
+_TABLES = OrderedDict()
+_TABLES_LOCK = threading.Lock()
+_MAX_TABLES = 64
+
+
+def _compiled(key, build):
+    with _TABLES_LOCK:
+        if key in _TABLES:
+            _TABLES.move_to_end(key)
+            return _TABLES[key]
+    value = build()
+    with _TABLES_LOCK:
+        _TABLES[key] = value
+        while len(_TABLES) > _MAX_TABLES:
+            _TABLES.popitem(last=False)
+    return value
+
+
+class ToneCurve:
+    """A run of consecutive per-channel stages compiled into lookup tables.
+
+    Brightness, contrast, posterize and invert map each channel value
+    independently, so the whole run collapses into one 256-entry table per
+    channel. The tables are built by pushing a 0-255 ramp through the member
+    kernels (so they round exactly like the stages do) and only rebuilt when
+    the params or the contrast mean change; the image itself is touched once,
+    by Image.point. Inside a FusedStage the member kernels simply run on the
+    strip, since a float32 gather costs more than the arithmetic.
+    """
+    name = "tone"
+    halo = None
+    tileable = True
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.measure = stages[0].measure
+
+    def key(self, params):
+        return (self.name,) + tuple(stage.key(params) for stage in self.stages)
+
+    def lut(self, params, stat):
+        """768-entry table (R, G, B) for Image.point"""
+        def build():
+            ramp = np.repeat(np.arange(256, dtype=np.float32)[None, :, None], 3, axis=2)
+            self.kernel(ramp, params, stat)
+            return ramp[0].T.astype(np.uint8).ravel().tolist()
+        return _compiled((self.key(params), stat), build)
+
+    def apply(self, im, params, stat=None):
+        if stat is None and self.measure:
+            stat = self.measure(im)
+        return im.point(self.lut(params, stat))
+
+    def kernel(self, x, params, stat):
+        for stage in self.stages:
+            stage.kernel(x, params, stat)
+
+
+# Grid sizes whose points all land on whole 8-bit values (step 255 / (size - 1))
+COLOR_LUT_SIZES = (16, 18, 52, 86)
+# Largest error, in 8-bit levels, a ColorCube may show on its probe colours
+# before it falls back to the exact kernels. Pillow's own HSV round trip in
+# hue shift is already off by several levels, so this can't be much tighter.
+COLOR_LUT_TOLERANCE = 8
+
+
+def _probe_colors():
+    # Fixed spread of colours the cube is checked against: random ones plus
+    # the greys and primaries/secondaries where stages tend to misbehave
+    rng = np.random.default_rng(0)
+    colors = [rng.integers(0, 256, (4096, 3))]
+    ramp = np.arange(256)
+    for mask in ((1, 1, 1), (1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 0), (1, 0, 1), (0, 1, 1)):
+        colors.append(ramp[:, None] * np.array(mask))
+    return np.concatenate(colors).astype(np.float32)[None]
+
+
+class ColorCube:
+    """A run of pointwise stages baked into a 3D colour lookup table.
+
+    Colour-mixing stages (grayscale, saturation, sepia, hue) can't be split
+    per channel, but any run of pointwise stages is still just a function of
+    the RGB triple. The run is evaluated exactly on a size**3 grid and the
+    image gets one trilinear Color3DLUT pass. The cube is only rebuilt when
+    the params (or the contrast mean) change.
+
+    Interpolation is an approximation, so each new cube is checked against
+    the exact kernels on a fixed set of probe colours; above
+    COLOR_LUT_TOLERANCE apply() falls back to the exact fused pass
+    (posterize is the usual culprit).
+    """
+    name = "cube"
+    halo = None
+    tileable = True
+
+    def __init__(self, stages, size=18):
+        if size not in COLOR_LUT_SIZES:
+            raise ValueError(f"Colour LUT size must be one of {COLOR_LUT_SIZES}")
+        self.stages = stages
+        self.size = size
+        self.measure = stages[0].measure
+        self.exact = FusedStage(stages)
+
+    def key(self, params):
+        return (self.name, self.size) + tuple(stage.key(params) for stage in self.stages)
+
+    def _run(self, x, params, stat):
+        for stage in self.stages:
+            stage.kernel(x, params, stat)
+        return x
+
+    def build(self, params, stat):
+        """(Color3DLUT, worst probe error in 8-bit levels)"""
+        def build():
+            v = np.arange(self.size, dtype=np.float32) * (255 // (self.size - 1))
+            b, g, r = np.meshgrid(v, v, v, indexing="ij")
+            grid = np.stack([r, g, b], axis=-1).reshape(1, -1, 3)
+            table = self._run(grid, params, stat) / 255
+            lut = ImageFilter.Color3DLUT(self.size, table.ravel())
+
+            probe = _probe_colors()
+            approx = np.asarray(Image.fromarray(probe.astype(np.uint8)).filter(lut), dtype=np.float32)
+            error = float(np.abs(approx - self._run(probe, params, stat)).max())
+            return lut, error
+        return _compiled((self.key(params), stat), build)
+
+    def apply(self, im, params, stat=None):
+        if stat is None and self.measure:
+            stat = self.measure(im)
+        lut, error = self.build(params, stat)
+        if error > COLOR_LUT_TOLERANCE:
+            return self.exact.apply(im, params, stat)
+        return im.filter(lut)
+
+
+def _tone_curves(run):
+    # Merge consecutive per-channel stages of a pointwise run into ToneCurves
+    members = []
+    tone = []
+    for stage in run + [None]:
+        if stage is not None and stage.per_channel:
+            tone.append(stage)
+            continue
+        if tone:
+            members.append(ToneCurve(tone))
+            tone = []
+        if stage is not None:
+            members.append(stage)
+    return members
+
+
+def plan(params, fuse=False, lut=False, color_lut=0):
+    """The steps that actually do something for these params, in order.
+
+    With fuse=True, runs of two or more consecutive pointwise stages are
+    merged into a FusedStage. With lut=True, consecutive per-channel stages
+    are compiled into a ToneCurve. With a color_lut grid size, runs that
+    contain a colour-mixing stage become a ColorCube instead (approximate,
+    see ColorCube). A stage that needs a statistic of its input (contrast)
+    always starts a new run.
+    """
+    stages = [stage for stage in STAGES if stage.active(params)]
+    if not (fuse or lut or color_lut):
+        return stages
+
+    steps = []
+    run = []
+
+    def flush():
+        if color_lut and any(not stage.per_channel for stage in run):
+            steps.append(ColorCube(list(run), color_lut))
+            run.clear()
+            return
+        members = _tone_curves(run) if lut else list(run)
+        if fuse and len(members) > 1:
+            steps.append(FusedStage(members))
+        else:
+            steps.extend(members)
+        run.clear()
+
+    for stage in stages:
+        if stage.kernel is None:
+            flush()
+            steps.append(stage)
+        else:
+            if stage.measure:
+                flush()
+            run.append(stage)
+    flush()
+    return steps
+
+
+def image_nbytes(im):
+    """Memory taken by an image's pixels (multi-band 8-bit images use 32-bit pixels)"""
+    return im.width * im.height * (4 if len(im.getbands()) > 1 else 1)
+
+
+class StageCache:
+    """LRU cache of intermediate stage outputs under a byte budget.
+
+    An entry is keyed by its source image and the keys of every active stage
+    up to and including the one that produced it, so moving a slider only
+    re-runs the stages after it. Alongside the image it keeps the
+    whole-image statistics measured on the way there (see render's stats).
+    Sources are tracked by identity: keep passing the same image object to
+    get hits, and never modify images handed out by render() in place.
+    """
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._sources = {}
+        self._lock = threading.RLock()
+
+    def source_token(self, image):
+        with self._lock:
+            token = id(image)
+            ref = self._sources.get(token)
+            if ref is None or ref() is not image:
+                # New image (possibly reusing a dead one's id)
+                self._drop_source(token)
+                self._sources[token] = weakref.ref(image, lambda r, t=token: self._forget(t, r))
+            return token
+
+    def get(self, token, prefix):
+        """(image, stats) stored for this prefix, or None"""
+        with self._lock:
+            entry = self._entries.get((token, prefix))
+            if entry is not None:
+                self._entries.move_to_end((token, prefix))
+            return entry
+
+    def put(self, token, prefix, im, stats=None):
+        size = image_nbytes(im)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            key = (token, prefix)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= image_nbytes(old[0])
+            self._entries[key] = (im, dict(stats or {}))
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= image_nbytes(evicted[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sources.clear()
+            self.nbytes = 0
+
+    def _forget(self, token, ref):
+        with self._lock:
+            if self._sources.get(token) is ref:
+                self._drop_source(token)
+
+    def _drop_source(self, token):
+        self._sources.pop(token, None)
+        for key in [k for k in self._entries if k[0] == token]:
+            self.nbytes -= image_nbytes(self._entries.pop(key)[0])
+
+
+def output_size(size, params):
+    """Size of render()'s result for a source of this size"""
+    return _rotation_matrix(size, -params.rotation)[1]
+
+
+def open_rgb(path):
+    """Decode an image file as RGB, in one buffer when it already is RGB"""
+    im = Image.open(path)
+    if im.mode == "RGB":
+        # convert() would hand back a copy
+        im.load()
+        return im
+    return im.convert("RGB")
+
+
+class Pyramid:
+    """Successively halved copies of a source image.
+
+    Level k is the source averaged over 2**k x 2**k blocks (any odd last
+    row or column dropped), so it maps onto the source by an exact factor.
+    Levels are built on first use, or all at once in the background with
+    build_async(); either way each is computed from the one above it.
+    """
+    # Don't go below this many pixels on the short side
+    MIN_SIZE = 16
+
+    def __init__(self, image):
+        self.image = image
+        self._levels = [image]
+        self._lock = threading.Lock()
+
+    def build(self):
+        self.level(0.0)
+
+    def build_async(self):
+        threading.Thread(target=self.build, name="pyramid", daemon=True).start()
+
+    def level(self, scale):
+        """(k, image) for the smallest level at least `scale` times the source size"""
+        with self._lock:
+            k = 0
+            while 0.5 ** (k + 1) >= scale and self._build(k + 1):
+                k += 1
+            return k, self._levels[k]
+
+    def _build(self, k):
+        # Whether level k exists, making it from the one above if need be
+        if k < len(self._levels):
+            return True
+        top = self._levels[-1]
+        w, h = top.width // 2, top.height // 2
+        if min(w, h) < self.MIN_SIZE:
+            return False
+        self._levels.append(top.reduce(2, (0, 0, 2 * w, 2 * h)))
+        return True
+
+    def level_for(self, size):
+        """The smallest level at least `size` on both axes"""
+        return self.level(max(size[0] / self.image.width, size[1] / self.image.height))[1]
+
+
+class Region:
+    """Source side of a planned region render: crop, downscale and rotate
+    just the part of the source that the requested output depends on.
+
+    Produced by plan_region(); it runs as the first step of the chain, so
+    its output is cached like any other stage, and finish() turns the
+    rendered piece into the requested crop and size. `params` are what the
+    rest of the chain runs with (rescaled neighbourhoods); the geometry
+    stage is replaced by this one. With a pyramid `level` (k, image), the
+    piece is resampled from that level instead of the full source.
+    """
+    name = "region"
+    measure = None
+    tileable = False
+
+    def __init__(self, params, box, piece_size, matrix, region_size, inner, size, level=None):
+        self.params = params
+        self.box = box
+        self.piece_size = piece_size
+        self.matrix = matrix
+        self.region_size = region_size
+        self.inner = inner
+        self.size = size
+        self.level = level
+
+    def key(self, params):
+        k = self.level[0] if self.level else 0
+        return (self.name, self.box, self.piece_size, self.matrix, self.region_size, k)
+
+    def apply(self, im, params):
+        box = self.box
+        if self.level:
+            k, im = self.level
+            # Clamped for the odd row or column a level may have dropped
+            x0, y0, x1, y1 = (v / 2 ** k for v in box)
+            box = (min(x0, im.width - 1), min(y0, im.height - 1), min(x1, im.width), min(y1, im.height))
+        if self.piece_size != (box[2] - box[0], box[3] - box[1]):
+            piece = im.resize(self.piece_size, Image.Resampling.LANCZOS, box=box)
+        else:
+            piece = im.crop(box)
+        if self.matrix is not None:
+            piece = piece.transform(self.region_size, Image.Transform.AFFINE, self.matrix,
+                                    Image.Resampling.BICUBIC)
+        return piece
+
+    def finish(self, im):
+        if self.size and self.inner == (0, 0) + self.size and im.size == self.size:
+            # Rendered at the requested size already (see plan_region)
+            return im
+        if self.size:
+            return im.resize(self.size, Image.Resampling.LANCZOS, box=self.inner)
+        if self.inner != (0, 0) + im.size:
+            return im.crop(self.inner)
+        return im
+
+
+def plan_region(source_size, params, crop=None, size=None, pyramid=None):
+    """Plan render(image, params).crop(crop).resize(size) so that the filter
+    stages only ever see the pixels that end up in the result.
+
+    Pointwise stages commute with cropping and resampling, so the source is
+    cropped (with a halo for the neighbourhood stages) and downscaled first.
+    Blur and median sizes are rescaled to match; the fixed 3x3 filters are
+    not. Rotation and flips are done with an explicit affine matrix so that
+    a piece of the source lands exactly where it would in the full frame.
+    Contrast and auto contrast see only the region, so their statistics can
+    differ slightly from a full-frame render. With a Pyramid of the source,
+    the downscale starts from the smallest level that is still big enough.
+    """
+    w, h = source_size
+    if params.rotation != 0 or params.flip_horizontal or params.flip_vertical:
+        matrix, (fw, fh) = _geometry_matrix(source_size, params)
+    else:
+        matrix, (fw, fh) = None, source_size
+
+    x0, y0, x1, y1 = crop if crop else (0, 0, fw, fh)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"Empty crop box {crop}")
+
+    # Work at the smallest scale that still covers the output on both axes
+    scale = 1.0
+    if size:
+        scale = min(1.0, max(size[0] / (x1 - x0), size[1] / (y1 - y0)))
+    gw, gh = max(1, round(fw * scale)), max(1, round(fh * scale))
+    if size and (x0, y0, x1, y1) == (0, 0, fw, fh) and size[0] <= fw and size[1] <= fh:
+        # The whole frame, downscaled: work at exactly the output size, so
+        # the source is resampled once and finish() has nothing left to do
+        gw, gh = size
+    gx, gy = gw / fw, gh / fh
+
+    scaled = params
+    for stage in STAGES:
+        if stage.rescale and stage.active(scaled):
+            scaled = replace(scaled, **stage.rescale(scaled, scale))
+    halo = sum(stage.halo(scaled) for stage in plan(scaled) if stage.halo)
+
+    # Region of the scaled frame to render: the output plus the halo
+    inner = (x0 * gx, y0 * gy, x1 * gx, y1 * gy)
+    rx0 = max(0, math.floor(inner[0]) - halo)
+    ry0 = max(0, math.floor(inner[1]) - halo)
+    rx1 = min(gw, math.ceil(inner[2]) + halo)
+    ry1 = min(gh, math.ceil(inner[3]) + halo)
+    inner = (inner[0] - rx0, inner[1] - ry0, inner[2] - rx0, inner[3] - ry0)
+    # Float noise (999.9999999999999 for 1000) would cost a resample
+    inner = tuple(round(v) if abs(v - round(v)) < 1e-6 else v for v in inner)
+    if not size:
+        inner = tuple(int(v) for v in inner)
+
+    if matrix is None:
+        box = (rx0 / gx, ry0 / gy, rx1 / gx, ry1 / gy)
+        piece_size = (rx1 - rx0, ry1 - ry0)
+        region_matrix = None
+    else:
+        # Source area under the region, plus bicubic support
+        a, b, c, d, e, f = matrix
+        corners = [(x / gx, y / gy) for x in (rx0, rx1) for y in (ry0, ry1)]
+        xs = [a * x + b * y + c for x, y in corners]
+        ys = [d * x + e * y + f for x, y in corners]
+        margin = 2 / scale
+        qx0 = min(max(0, math.floor(min(xs) - margin)), w - 1)
+        qy0 = min(max(0, math.floor(min(ys) - margin)), h - 1)
+        qx1 = max(min(w, math.ceil(max(xs) + margin)), qx0 + 1)
+        qy1 = max(min(h, math.ceil(max(ys) + margin)), qy0 + 1)
+        box = (qx0, qy0, qx1, qy1)
+        piece_size = (max(1, round((qx1 - qx0) * scale)), max(1, round((qy1 - qy0) * scale)))
+        px, py = piece_size[0] / (qx1 - qx0), piece_size[1] / (qy1 - qy0)
+        # piece coords = p * (M((out + region origin) / g) - box origin)
+        region_matrix = (
+            px * a / gx, px * b / gy, px * (a * rx0 / gx + b * ry0 / gy + c - qx0),
+            py * d / gx, py * e / gy, py * (d * rx0 / gx + e * ry0 / gy + f - qy0),
+        )
+
+    level = None
+    if pyramid is not None:
+        level = pyramid.level(min(piece_size[0] / (box[2] - box[0]),
+                                  piece_size[1] / (box[3] - box[1])))
+    return Region(scaled, box, piece_size, region_matrix, (rx1 - rx0, ry1 - ry0), inner,
+                  tuple(size) if size else None, level)
+
+
+# Edge length of the square tiles render() works in with tile_size=True
+TILE_SIZE = 512
+
+
+class Cancelled(Exception):
+    """Raised by render() once its cancel callback returns True"""
+
+
+def _stat_key(step, params):
+    # A merged step measures for the stage it starts with; key the statistic
+    # by that stage alone, since whatever got merged in after it can differ
+    # between a frame and its tiles (e.g. a median scaled away in one)
+    return getattr(step, "stages", (step,))[0].key(params)
+
+
+def _tileable(step):
+    # Steps that measure their whole input or move pixels around can't be
+    # run piecewise; everything else only looks at a bounded neighbourhood
+    return step.tileable and step.measure is None
+
+
+def _tiles(size, tile_size):
+    w, h = size
+    for top in range(0, h, tile_size):
+        for left in range(0, w, tile_size):
+            yield (left, top, min(w, left + tile_size), min(h, top + tile_size))
+
+
+def _render_tile(im, steps, params, box, halo):
+    # Run the steps on the tile plus enough context that its own pixels come
+    # out exactly as in a whole-image pass; filters are only wrong within
+    # their reach of the piece's edge, and the halo absorbs that
+    w, h = im.size
+    x0, y0, x1, y1 = box
+    outer = (max(0, x0 - halo), max(0, y0 - halo), min(w, x1 + halo), min(h, y1 + halo))
+    piece = im.crop(outer)
+    for step in steps:
+        piece = step.apply(piece, params)
+    inner = (x0 - outer[0], y0 - outer[1], x1 - outer[0], y1 - outer[1])
+    return piece.crop(inner) if inner != (0, 0) + piece.size else piece
+
+
+def _render_tiled(im, steps, params, tile_size, workers=1, cancel=None):
+    """Run a sequence of tileable steps tile by tile into one output image.
+
+    Peak memory is the input and output plus a few tile-sized pieces,
+    instead of a full-size intermediate per stage. With workers > 1 the
+    tiles are rendered on a thread pool (Pillow and NumPy release the GIL
+    in their inner loops); at most two tiles per worker are in flight.
+    """
+    halo = sum(step.halo(params) for step in steps if step.halo)
+    out = Image.new(im.mode, im.size)
+    if workers <= 1:
+        for box in _tiles(im.size, tile_size):
+            if cancel and cancel():
+                raise Cancelled()
+            out.paste(_render_tile(im, steps, params, box, halo), box[:2])
+        return out
+
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for box in _tiles(im.size, tile_size):
+            if cancel and cancel():
+                raise Cancelled()
+            pending.append((box, pool.submit(_render_tile, im, steps, params, box, halo)))
+            if len(pending) >= 2 * workers:
+                box, future = pending.popleft()
+                out.paste(future.result(), box[:2])
+        for box, future in pending:
+            out.paste(future.result(), box[:2])
+    return out
+
+
+def render(im, params, cache=None, fuse=False, lut=False, color_lut=0, crop=None, size=None,
+           tile_size=None, workers=1, cancel=None, pyramid=None, stats=None):
+    """Run the whole filter chain on an RGB image and return the result.
+
+    With a StageCache, the longest already-computed prefix of the chain is
+    picked up from the cache and only the remaining stages are run. The
+    result may then be shared with the cache, so treat it as read-only.
+    fuse=True evaluates runs of pointwise stages in a single pass and
+    lut=True applies per-channel tone stages as lookup tables; both give
+    the same output with less work. color_lut=<grid size> trades exactness
+    for speed on colour-mixing stages and is meant for previews.
+
+    crop (a box in the rendered frame) and size ask for
+    render(...).crop(crop).resize(size); the chain is then run through
+    plan_region so it only works on the pixels that survive, starting from
+    the given Pyramid of `im` if there is one.
+
+    tile_size=<pixels> (TILE_SIZE is a sensible default) runs stretches of
+    neighbourhood and pointwise stages tile by tile, with each tile padded
+    by the context the stretch reads, so memory stays bounded on very large
+    images. Geometry, contrast and auto contrast still see the whole frame.
+    The output is identical. With a cache, every step is still tiled (and
+    cached) on its own, so a later change picks up where it did untiled.
+    workers=<n> renders the tiles on n threads (tiling with TILE_SIZE if
+    no tile_size is given), again with identical output.
+
+    cancel is an optional callable checked between steps (and tiles); once
+    it returns True, render() gives up by raising Cancelled.
+
+    stats is an optional dict of whole-image statistics (contrast mean,
+    auto contrast extrema) by the key of the stage that measures them.
+    Steps use the entry for their key if there is one, otherwise they
+    measure their input and add it. Pass the dict filled in by a render of
+    the whole frame to region renders of its parts, and they all stretch
+    and mean the same way, without seams.
+    """
+    if workers > 1 and not tile_size:
+        tile_size = TILE_SIZE
+    region = None
+    if crop is not None or size is not None:
+        region = plan_region(im.size, params, crop, size, pyramid)
+        params = region.params
+        stages = [region] + [step for step in plan(params, fuse, lut, color_lut)
+                             if step.name != "geometry"]
+    else:
+        stages = plan(params, fuse, lut, color_lut)
+    if stats is None:
+        stats = {}
+    prefixes = []
+    prefix = ()
+    for stage in stages:
+        key = stage.key(params)
+        # A statistic handed in rather than measured changes the output
+        if stage.measure and _stat_key(stage, params) in stats:
+            key = (key, stats[_stat_key(stage, params)])
+        prefix += (key,)
+        prefixes.append(prefix)
+
+    # Statistics used by the steps run so far, kept with their cache entries
+    measured = {}
+    start = 0
+    if cache is not None:
+        token = cache.source_token(im)
+        for i in range(len(stages), 0, -1):
+            hit = cache.get(token, prefixes[i - 1])
+            if hit is not None:
+                im, measured = hit[0], dict(hit[1])
+                for key, stat in measured.items():
+                    stats.setdefault(key, stat)
+                start = i
+                break
+
+    i = start
+    while i < len(stages):
+        if cancel and cancel():
+            raise Cancelled()
+        j = i + 1
+        if tile_size and _tileable(stages[i]):
+            # Only uncached renders skip the intermediates between steps
+            while cache is None and j < len(stages) and _tileable(stages[j]):
+                j += 1
+            im = _render_tiled(im, stages[i:j], params, tile_size, workers, cancel)
+        elif stages[i].measure:
+            key = _stat_key(stages[i], params)
+            if key not in stats:
+                stats[key] = stages[i].measure(im)
+            measured[key] = stats[key]
+            im = stages[i].apply(im, params, stats[key])
+        else:
+            im = stages[i].apply(im, params)
+        if cache is not None:
+            cache.put(token, prefixes[j - 1], im, measured)
+        i = j
+
+    if region is not None:
+        im = region.finish(im)
+    return im
@@ -0,0 +1,290 @@
+"""Undo/redo history for the destructive edits (crop, resize).
+
+Rather than a full copy of the image per step, the history is a log of the
+operations applied since the image was loaded, plus the occasional
+keyframe snapshot to replay them from. Images are treated as immutable:
+every operation returns a new one, so a keyframe can share its pixels with
+the image on screen.
+
+Keyframes live in a SnapshotStore, which compresses them in the background
+and moves the least recently used out of RAM into a scratch file.
+"""
+from collections import OrderedDict
+from PIL import Image
+from engine import image_nbytes
+import io
+import itertools
+import mmap
+import tempfile
+import threading
+import weakref
+
+# A keyframe every this many operations, so an undo replays fewer than that
+KEYFRAME_INTERVAL = 4
+
+
+def apply_op(im, op):
+    """Apply one logged operation, e.g. ("crop", box) or ("resize", size)"""
+    name, arg = op
+    if name == "crop":
+        return im.crop(arg)
+    if name == "resize":
+        return im.resize(arg, Image.Resampling.LANCZOS)
+    raise ValueError(f"Unknown operation: {name}")
+
+
+class _Snapshot:
+    def __init__(self, image):
+        self.image = image  # Until compressed
+        self.ref = weakref.ref(image)  # Free to use while someone else holds it
+        self.data = None  # Compressed, in RAM
+        self.offset = None  # Compressed, at this offset of the scratch file
+        self.length = 0
+
+    @property
+    def nbytes(self):
+        return image_nbytes(self.image) if self.image is not None else self.length
+
+    @property
+    def ram_bytes(self):
+        if self.image is not None:
+            return image_nbytes(self.image)
+        return self.length if self.data is not None else 0
+
+
+class SnapshotStore:
+    """Images kept for later, compressed and spilled to disk under a RAM budget.
+
+    put() returns at once: a background thread compresses each snapshot
+    (lossless PNG, fast setting) after which the raw pixels are let go.
+    Whenever the snapshots held in RAM come to more than ram_bytes, the
+    least recently used compressed ones are appended to an anonymous
+    scratch file in `directory` (the system temp folder by default) and
+    read back through a memory map when needed. get() hands back the
+    original image object if it is still alive elsewhere, and otherwise
+    decodes it again.
+    """
+    def __init__(self, ram_bytes=256 * 1024 * 1024, directory=None):
+        self.ram_bytes = ram_bytes
+        self.directory = directory
+        self._lock = threading.Condition()
+        self._entries = OrderedDict()
+        self._keys = itertools.count()
+        self._queue = []  # Keys waiting to be compressed
+        self._file = None
+        self._map = None
+        self._file_bytes = 0
+        threading.Thread(target=self._run, name="snapshot-store", daemon=True).start()
+
+    def put(self, image):
+        """Keep image; returns the key to get it back with"""
+        with self._lock:
+            key = next(self._keys)
+            self._entries[key] = _Snapshot(image)
+            self._queue.append(key)
+            self._lock.notify()
+            return key
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            image = entry.image if entry.image is not None else entry.ref()
+            if image is not None:
+                return image
+            data = entry.data
+            if data is None:
+                data = self._map[entry.offset:entry.offset + entry.length]
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        with self._lock:
+            if key in self._entries:
+                self._entries[key].ref = weakref.ref(image)
+        return image
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._compact()
+
+    def nbytes(self, key=None):
+        """Size of one snapshot as stored right now, or of all of them"""
+        with self._lock:
+            if key is not None:
+                return self._entries[key].nbytes
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._queue = []
+            self._compact()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._lock.wait()
+                key = self._queue.pop(0)
+                entry = self._entries.get(key)
+                image = entry.image if entry is not None else None
+            if image is None:
+                continue
+            buffer = io.BytesIO()
+            image.save(buffer, "PNG", compress_level=1)
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    entry.data = buffer.getvalue()
+                    entry.length = len(entry.data)
+                    entry.image = None
+                    self._spill()
+
+    def _spill(self):
+        # Oldest first, until the compressed snapshots left in RAM fit
+        ram = sum(entry.ram_bytes for entry in self._entries.values())
+        for entry in self._entries.values():
+            if ram <= self.ram_bytes:
+                break
+            if entry.data is None:
+                continue
+            if self._file is None:
+                self._file = tempfile.TemporaryFile(dir=self.directory)
+            self._file.seek(self._file_bytes)
+            self._file.write(entry.data)
+            self._file.flush()
+            entry.offset = self._file_bytes
+            self._file_bytes += entry.length
+            ram -= entry.length
+            entry.data = None
+        self._remap()
+
+    def _compact(self):
+        # Discarded snapshots leave holes in the scratch file; once they
+        # outweigh what is still in use, copy the rest back into RAM and
+        # start the file over
+        spilled = [entry for entry in self._entries.values() if entry.offset is not None]
+        live = sum(entry.length for entry in spilled)
+        if self._file is None or self._file_bytes <= 2 * live:
+            return
+        for entry in spilled:
+            entry.data = self._map[entry.offset:entry.offset + entry.length]
+            entry.offset = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+        self._file = None
+        self._file_bytes = 0
+        self._spill()
+
+    def _remap(self):
+        if self._file is None or (self._map is not None and len(self._map) == self._file_bytes):
+            return
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), self._file_bytes, access=mmap.ACCESS_READ)
+
+
+class History:
+    """Operation log with sparse keyframes under a byte budget.
+
+    State i is the image after the first i operations; state 0, the base,
+    is always a keyframe, and so is every KEYFRAME_INTERVAL-th state once
+    it has been reached. Undo replays from the nearest keyframe at or
+    before the state it goes back to; redo applies one operation to the
+    current image. Keyframes are kept in `store` (a SnapshotStore) and
+    max_bytes caps what they take up there, compressed or not. When they
+    outgrow it, the ones only redo could use go first, then the oldest
+    history is dropped by making the next keyframe the base, and finally
+    everything before the current state.
+    """
+    def __init__(self, max_bytes=512 * 1024 * 1024, store=None):
+        self.max_bytes = max_bytes
+        self.store = store if store is not None else SnapshotStore()
+        self.clear()
+
+    def clear(self):
+        self.ops = []
+        self.keyframes = {}  # State -> store key
+        self.store.clear()
+        self.position = 0
+        self.current = None
+
+    def reset(self, image):
+        """Start a new history at image"""
+        self.clear()
+        self.current = image
+        self.keyframes[0] = self.store.put(image)
+        self._trim()
+
+    @property
+    def nbytes(self):
+        return sum(self.store.nbytes(key) for key in self.keyframes.values())
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.ops)
+
+    def record(self, op, image):
+        """Log op, which turned the current image into image; drops any redo"""
+        del self.ops[self.position:]
+        for i in [i for i in self.keyframes if i > self.position]:
+            self.store.discard(self.keyframes.pop(i))
+        self.ops.append(op)
+        self._move_to(self.position + 1, image)
+
+    def undo(self):
+        """The previous image, or None at the start of the history"""
+        if not self.can_undo():
+            return None
+        target = self.position - 1
+        start = max(i for i in self.keyframes if i <= target)
+        im = self.store.get(self.keyframes[start])
+        for op in self.ops[start:target]:
+            im = apply_op(im, op)
+        self._move_to(target, im)
+        return im
+
+    def redo(self):
+        """The next image, or None at the end of the history"""
+        if not self.can_redo():
+            return None
+        key = self.keyframes.get(self.position + 1)
+        if key is not None:
+            im = self.store.get(key)
+        else:
+            im = apply_op(self.current, self.ops[self.position])
+        self._move_to(self.position + 1, im)
+        return im
+
+    def _move_to(self, position, image):
+        self.position = position
+        self.current = image
+        if position % KEYFRAME_INTERVAL == 0 and position not in self.keyframes:
+            self.keyframes[position] = self.store.put(image)
+        self._trim()
+
+    def _trim(self):
+        while self.nbytes > self.max_bytes:
+            redo_only = [i for i in self.keyframes if i > self.position]
+            if redo_only:
+                self.store.discard(self.keyframes.pop(max(redo_only)))
+                continue
+            later = sorted(i for i in self.keyframes if 0 < i <= self.position)
+            self._rebase(later[0] if later else self.position)
+            if not later:
+                break
+
+    def _rebase(self, start):
+        # State `start` becomes the base; everything before it is forgotten
+        base = self.keyframes.pop(start, None)
+        if base is None:
+            base = self.store.put(self.current)
+        for i in [i for i in self.keyframes if i < start]:
+            self.store.discard(self.keyframes.pop(i))
+        self.keyframes = {i - start: key for i, key in self.keyframes.items()}
+        self.keyframes[0] = base
+        del self.ops[:start]
+        self.position -= start
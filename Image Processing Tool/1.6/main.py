@@ -1,8 +1,65 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-from PIL import Image, ImageTk, ImageFilter, ImageEnhance, ImageOps
+from collections import OrderedDict
+from contextlib import contextmanager
+from PIL import Image, ImageTk
+import math
 import os
-import numpy as np
+import sys
+import time
+import batch
+from engine import FilterParams, Pyramid, StageCache, open_rgb, output_size, render
+from history import History, SnapshotStore, apply_op
+from preview import RenderTimes, RenderWorker
+
+# Colour LUT grid used for fast preview (see engine.ColorCube)
+PREVIEW_COLOR_LUT = 18
+# Threads the filter chain is tiled across (see engine.render)
+RENDER_WORKERS = os.cpu_count() or 1
+# How often the Tk loop checks for a finished preview frame
+RENDER_POLL_MS = 15
+# Longest side of the first, near-instant preview pass
+PROGRESSIVE_FIRST_SIZE = 200
+# Without fast preview, how long the settings must stay put before a
+# full-resolution pass too slow for the frame budget starts
+FULL_RES_PAUSE_MS = 400
+# While settings change, a new render waits until the preview passes that
+# fit in this budget (by measured render time) should be done, so each of
+# them gets shown; finer passes only run once the settings stay put
+PREVIEW_FRAME_BUDGET_MS = 250
+# While a slider is held down, the preview is just one pass at the canvas
+# size divided by this, redone at full preview quality on release
+DRAG_PROXY_REDUCTION = 4
+# Fast preview renders at the canvas size times a scale, stepped by this
+# factor (on each side) down to the minimum while this machine can't fit
+# the render into the frame budget, and back up when it can
+PREVIEW_SCALE_STEP = 2 ** 0.25
+PREVIEW_SCALE_MIN = 0.25
+# Zoomed in past the whole image, the view is rendered in display tiles of
+# this size, and this many are kept around for panning back over
+VIEW_TILE_SIZE = 256
+VIEW_TILE_CACHE = 256
+# Deepest zoom in screen pixels per image pixel, and the mouse wheel's step
+MAX_PIXEL_ZOOM = 8
+ZOOM_STEP = 1.25
+# A resize, zoom or pan counts as over once it has been still this long;
+# until then the display is resampled cheaply, afterwards with LANCZOS
+GESTURE_SETTLE_MS = 150
+# Resized display frames kept, by (frame, size, box, filter)
+DISPLAY_FRAME_CACHE = 8
+# Space the undo history's snapshots may take up, compressed or not, and
+# how much of that may stay in RAM before the rest goes to a scratch file
+HISTORY_BYTES = 2 * 1024 * 1024 * 1024
+HISTORY_RAM_BYTES = 256 * 1024 * 1024
+
+
+def fit_size(size, box):
+    """size scaled down to fit inside box, or None if it already fits"""
+    w, h = size
+    scale = min(box[0] / w, box[1] / h)
+    if scale >= 1.0:
+        return None
+    return (max(1, int(w * scale)), max(1, int(h * scale)))
 
 class ImageProcessorApp:
     def __init__(self, root):
@@ -24,8 +81,10 @@ class ImageProcessorApp:
         self.image = None
         self.original_image = None
         self.image_path = ""
-        self.undo_stack = []
-        self.redo_stack = []
+        self.history = History(HISTORY_BYTES, SnapshotStore(HISTORY_RAM_BYTES))
+        # Open settings transactions, and whether one has held back a render
+        self._transaction_depth = 0
+        self._transaction_dirty = False
         # Filter variables (examples)
         self.grayscale_var = tk.DoubleVar(value=0)
         self.blur_var = tk.DoubleVar(value=0)
@@ -48,11 +107,54 @@ class ImageProcessorApp:
         self.preview_enabled = tk.BooleanVar(value=True)  # Preview checkbox
         self.fast_preview = tk.BooleanVar(value=True)  # Toggle for optimized (fast) preview
 
-        # Debounce
-        self._after_id = None
-
-        # Canvas image item
+        # Intermediate stage outputs, so a slider only re-runs the stages after it
+        self.stage_cache = StageCache()
+        # Halved copies of the current source, for previews and display
+        self.pyramid = None
+        # Previews render off the Tk thread; finished frames are polled for
+        self.render_worker = RenderWorker()
+        self.render_times = RenderTimes()
+        self.preview_scale = 1.0
+        # Display size the latest preview passes were rendered for
+        self.render_screen = None
+        # Throttling of schedule_apply (see PREVIEW_FRAME_BUDGET_MS)
+        self._apply_id = None
+        self._last_apply = 0.0
+        self._apply_interval = 0.0
+        # A slider is held down, and whether a proxy preview was shown for it
+        self.dragging = False
+        self.drag_proxy_shown = False
+        self._poll_id = None
+
+        # What the canvas shows: the frame, the full-resolution size it stands
+        # for and what it was rendered from (source, params, colour LUT,
+        # whole-image stats), so a zoomed-in view can render matching tiles
         self.canvas_image = None
+        # The canvas item's PhotoImage is kept and pasted into; only a change
+        # of size needs a new one
+        self.photo = None
+        self.photo_source = None
+        self.frame = None
+        self.frame_size = None
+        self.frame_render = None
+        self.frame_final = False
+        self.frame_pending = False
+        # Zoomed in: frame coordinates at the centre of the canvas, rendered
+        # tiles by (source id, params, colour LUT, scale, column, row), the
+        # canvas items showing them and the tiles being rendered
+        self.view_center = None
+        self.view_tiles = OrderedDict()
+        self.tile_items = {}
+        self.tiles_requested = set()
+        self._pan_from = None
+        # Resampled frames ready for the canvas, and the gesture in progress
+        self.frame_id = 0
+        self.display_frames = OrderedDict()
+        self._gesture_id = None
+        # Halved copies of a full-resolution frame, which the render worker
+        # resamples to the display size from, and the size it is working on
+        self.frame_pyramid = None
+        self.display_requested = None
 
         # Build UI
         self.create_widgets()
@@ -83,6 +185,8 @@ class ImageProcessorApp:
         self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)  # Zoom support Windows
         self.canvas.bind("<Button-4>", self.on_mouse_wheel)  # Linux scroll up
         self.canvas.bind("<Button-5>", self.on_mouse_wheel)  # Linux scroll down
+        self.canvas.bind("<ButtonPress-1>", self.on_pan_start)  # Drag to pan when zoomed in
+        self.canvas.bind("<B1-Motion>", self.on_pan)
 
         # Right - controls
         self.right_frame = tk.Frame(self.main_frame, bg="#F5F5F5")
@@ -184,6 +288,8 @@ class ImageProcessorApp:
             scale = ttk.Scale(frm, from_=min_, to=max_, variable=var, orient=tk.HORIZONTAL, length=200)
             scale.grid(row=row, column=1, padx=5, pady=1, sticky="ew")
             # No direct command on scale; handled via trace
+            scale.bind("<ButtonPress-1>", self.begin_drag, add="+")
+            scale.bind("<ButtonRelease-1>", self.end_drag, add="+")
 
             lbl = ttk.Label(frm, text=f"{var.get():.2f}" if not allow_int else f"{int(var.get())}")
             lbl.grid(row=row, column=2, padx=5, pady=1)
@@ -264,199 +370,528 @@ class ImageProcessorApp:
         path = filedialog.askopenfilename(filetypes=filetypes)
         if path:
             try:
-                img = Image.open(path).convert("RGB")
+                # One decoded buffer serves as the original, the current
+                # image, the frame on screen and the undo base: nothing here
+                # changes an image in place, every edit makes a new one
+                img = open_rgb(path)
                 self.image_path = path
-                self.original_image = img.copy()
+                self.original_image = img
+                self.initial_image = img
+                self.source_pyramid(self.original_image).build_async()
                 self.image = img
-                self.undo_stack.clear()
-                self.redo_stack.clear()
-                self.push_undo()
+                self.history.reset(self.original_image)
                 self.zoom_level = 1.0
+                self.view_center = None
                 self.display_image(self.image)
                 self.status_label.config(text=f"Loaded: {os.path.basename(self.image_path)}")
                 self.reset_filter_vars()
-                self.initial_image = img.copy()  # Keep immutable original
             except Exception as e:
                 messagebox.showerror("Error", f"Error loading image: {e}")
 
     def reset_filter_vars(self):
-        self.grayscale_var.set(0)
-        self.blur_var.set(0)
-        self.contrast_var.set(1)
-        self.brightness_var.set(1)
-        self.sharpen_var.set(0)
-        self.saturation_var.set(1)
-        self.edge_enhance_var.set(0)
-        self.rotation_var.set(0)
-        self.sepia_var.set(0)
-        self.posterize_var.set(8)
-        self.emboss_intensity_var.set(0)
-        self.hue_shift_var.set(0)
-        self.noise_reduction_size_var.set(1)
-        self.invert_active = False
-        self.flip_horizontal_active = False
-        self.flip_vertical_active = False
-        self.auto_contrast_active = False
-        self.resolution_var.set("1920x1080 (16:9)")
+        with self.settings_transaction():
+            self.grayscale_var.set(0)
+            self.blur_var.set(0)
+            self.contrast_var.set(1)
+            self.brightness_var.set(1)
+            self.sharpen_var.set(0)
+            self.saturation_var.set(1)
+            self.edge_enhance_var.set(0)
+            self.rotation_var.set(0)
+            self.sepia_var.set(0)
+            self.posterize_var.set(8)
+            self.emboss_intensity_var.set(0)
+            self.hue_shift_var.set(0)
+            self.noise_reduction_size_var.set(1)
+            self.invert_active = False
+            self.flip_horizontal_active = False
+            self.flip_vertical_active = False
+            self.auto_contrast_active = False
+            self.resolution_var.set("1920x1080 (16:9)")
 
     def reset_image(self):
         if self.initial_image:
-            self.original_image = self.initial_image.copy()
-            self.undo_stack.clear()
-            self.redo_stack.clear()
-            self.push_undo()
+            self.original_image = self.initial_image
+            self.history.reset(self.original_image)
             self.display_image(self.original_image)
             self.status_label.config(text="Image reset to original")
             self.reset_filter_vars()
 
+    @contextmanager
+    def settings_transaction(self):
+        """Group settings changes so they cost one render, once the outermost group ends"""
+        self._transaction_depth += 1
+        try:
+            yield
+        finally:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0 and self._transaction_dirty:
+                self._transaction_dirty = False
+                self.schedule_apply()
+
     def schedule_apply(self):
+        if self._transaction_depth:
+            self._transaction_dirty = True
+            return
         if not self.preview_enabled.get():
             return
-        if self.fast_preview.get():
-            if self._after_id is not None:
-                self.root.after_cancel(self._after_id)
-            self._after_id = self.root.after(200, self.apply_filters)
+        if self._apply_id is not None:
+            # One is already due, and will pick up these settings too
+            return
+        wait = self._last_apply + self._apply_interval - time.perf_counter()
+        if wait > 0:
+            self._apply_id = self.root.after(max(1, round(wait * 1000)), self.run_scheduled_apply)
         else:
+            self.run_scheduled_apply()
+
+    def run_scheduled_apply(self):
+        self._apply_id = None
+        if self.preview_enabled.get():
+            self._last_apply = time.perf_counter()
             self.apply_filters()
 
     def apply_filters(self):
-        self._after_id = None
         if not self.original_image:
             return
 
-        if self.fast_preview.get():
-            max_preview = 800
-            w, h = self.original_image.size
-            scale = min(1.0, max_preview / max(w, h))
-            if scale < 1.0:
-                base = self.original_image.resize((int(w * scale), int(h * scale)), Image.Resampling.LANCZOS)
-            else:
-                base = self.original_image.copy()
-            status_text = "Applied filters (fast preview)"
+        # Snapshot everything here; the passes run on the render worker
+        im = self.original_image
+        pyramid = self.source_pyramid(im)
+        params = self.get_filter_params()
+        full_size = output_size(im.size, params)
+        canvas = (max(self.canvas.winfo_width(), PROGRESSIVE_FIRST_SIZE),
+                  max(self.canvas.winfo_height(), PROGRESSIVE_FIRST_SIZE))
+        # Fitted to the canvas, passes render at exactly the size they'll be
+        # shown at, so putting them on screen takes no resampling; zoomed in,
+        # the frame is only the backdrop for the tiles
+        if self.view_center is None:
+            screen = self.display_size(full_size)
         else:
-            base = self.original_image.copy()
-            status_text = "Applied filters"
-
-        im = self.apply_filters_to(base)
-        self.image = im
-        self.display_image(self.image)
-        self.status_label.config(text=status_text)
-
-    def apply_filters_to(self, im):
-        # Rotation
-        if self.rotation_var.get() != 0:
-            im = im.rotate(-self.rotation_var.get(), expand=True, resample=Image.Resampling.BICUBIC)
-
-        # Grayscale blending
-        if self.grayscale_var.get() > 0:
-            gs = im.convert("L").convert("RGB")
-            im = Image.blend(im, gs, self.grayscale_var.get())
-
-        # Blur
-        if self.blur_var.get() > 0:
-            im = im.filter(ImageFilter.GaussianBlur(radius=self.blur_var.get()))
-
-        # Contrast
-        if self.contrast_var.get() != 1:
-            im = ImageEnhance.Contrast(im).enhance(self.contrast_var.get())
-
-        # Brightness
-        if self.brightness_var.get() != 1:
-            im = ImageEnhance.Brightness(im).enhance(self.brightness_var.get())
-
-        # Sharpen
-        if self.sharpen_var.get() > 0:
-            im = ImageEnhance.Sharpness(im).enhance(self.sharpen_var.get())
-
-        # Saturation
-        if self.saturation_var.get() != 1:
-            im = ImageEnhance.Color(im).enhance(self.saturation_var.get())
-
-        # Edge Enhance
-        if self.edge_enhance_var.get() > 0:
-            im = im.filter(ImageFilter.EDGE_ENHANCE)
-            if self.edge_enhance_var.get() > 1:
-                im = ImageEnhance.Sharpness(im).enhance(self.edge_enhance_var.get() / 2)
-
-        # Sepia Tone
-        if self.sepia_var.get() > 0:
-            sepia = self.apply_sepia(im)
-            im = Image.blend(im, sepia, self.sepia_var.get())
-
-        # Posterize
-        if self.posterize_var.get() < 8:
-            im = ImageOps.posterize(im, self.posterize_var.get())
-
-        # Emboss
-        if self.emboss_intensity_var.get() > 0:
-            im = im.filter(ImageFilter.EMBOSS)
-            if self.emboss_intensity_var.get() > 1:
-                im = ImageEnhance.Sharpness(im).enhance(self.emboss_intensity_var.get() / 2)
-
-        # Hue shift
-        if self.hue_shift_var.get() != 0:
-            im = self.shift_hue(im, self.hue_shift_var.get())
-
-        # Noise reduction (Median filter)
-        size = self.noise_reduction_size_var.get()
-        if size > 1:
-            if size % 2 == 0:
-                size += 1  # Make it odd
-            size = max(size, 3)  # Ensure at least 3
-            im = im.filter(ImageFilter.MedianFilter(size=size))
-
-        # Toggles
-        if self.invert_active:
-            im = ImageOps.invert(im)
-
-        if self.flip_horizontal_active:
-            im = im.transpose(Image.FLIP_LEFT_RIGHT)
-
-        if self.flip_vertical_active:
-            im = im.transpose(Image.FLIP_TOP_BOTTOM)
-
-        if self.auto_contrast_active:
-            im = ImageOps.autocontrast(im)
-
-        return im
-
-    def display_image(self, image):
-        if image:
-            canvas_width = self.canvas.winfo_width()
-            canvas_height = self.canvas.winfo_height()
-
-            img_width, img_height = image.size
-            # Apply zoom
-            display_width = int(img_width * self.zoom_level)
-            display_height = int(img_height * self.zoom_level)
+            screen = fit_size(full_size, canvas) or full_size
+        self.render_screen = screen
+        screen_size = None if screen == tuple(full_size) else screen
+
+        # Progressively finer (size, colour LUT, pause first, status) passes: a
+        # thumbnail straight away, then display resolution and, without fast
+        # preview, the exact full-resolution result once the user pauses.
+        # The engine resamples the source (from the nearest pyramid level)
+        # once, before the filters, so small passes are cheap.
+        thumbnail = (fit_size(full_size, (PROGRESSIVE_FIRST_SIZE,) * 2), PREVIEW_COLOR_LUT, False,
+                     "Rendering preview...")
+        if self.dragging:
+            # From a pyramid level a fraction of the canvas size, and nothing
+            # finer until the slider is let go
+            proxy = (canvas[0] // DRAG_PROXY_REDUCTION, canvas[1] // DRAG_PROXY_REDUCTION)
+            passes = [(fit_size(full_size, proxy), PREVIEW_COLOR_LUT, False, "Dragging (proxy preview)")]
+            self.drag_proxy_shown = True
+        elif self.fast_preview.get():
+            passes = [thumbnail, (self.fast_preview_size(full_size, screen, thumbnail[0]),
+                                  PREVIEW_COLOR_LUT, False, "Applied filters (fast preview)")]
+        elif self.view_center is not None:
+            # Zoomed in, the view gets rendered in tiles at full detail anyway
+            passes = [thumbnail, (screen_size, 0, False, "Applied filters")]
+        else:
+            passes = [thumbnail, (screen_size, 0, False, "Refining preview..."),
+                      (None, 0, True, "Applied filters")]
+        # Once a pass is at full size (so it fits the canvas) the rest have
+        # nothing to add, and it is cheap enough not to wait for a pause
+        for i, (size, _, _, _) in enumerate(passes):
+            if size is None:
+                passes = passes[:i] + [(None, passes[-1][1], False, passes[-1][3])]
+                break
+        # The next change may start a render once the passes that fit in the
+        # frame budget should be done; a full-resolution pass that fits in
+        # it doesn't need to wait for a pause either
+        budget = PREVIEW_FRAME_BUDGET_MS / 1000
+        interval = 0.0
+        for i, (size, color_lut, pause, status_text) in enumerate(passes):
+            cost = self.render_times.estimate(size or full_size, color_lut)
+            if pause and cost is not None and cost <= budget:
+                pause = False
+                passes[i] = (size, color_lut, pause, status_text)
+            if pause or cost is None or interval + cost > budget:
+                break
+            interval += cost
+        self._apply_interval = interval
+
+        def job(superseded):
+            for n, (size, color_lut, pause, status_text) in enumerate(passes, 1):
+                if pause and superseded.wait(FULL_RES_PAUSE_MS / 1000):
+                    return
+                stats = {}
+                start = time.perf_counter()
+                frame = self.apply_filters_to(im, color_lut, size, params, cancel=superseded.is_set,
+                                              pyramid=pyramid, stats=stats)
+                self.render_times.record(size or full_size, color_lut, time.perf_counter() - start)
+                # Scaling a full-resolution frame down to the display is
+                # too slow for the Tk thread; do it here while at it
+                shown = None
+                if size is None and screen_size is not None:
+                    frame_pyramid = Pyramid(frame)
+                    shown = (frame_pyramid, screen, self.resample_frame(frame_pyramid, screen))
+                yield "frame", (frame, full_size, (im, params, color_lut, stats), n == len(passes),
+                                status_text, shown)
+
+        self.render_worker.submit(job)
+        self.frame_pending = True
+        self.tiles_requested.clear()
+        self.watch_render()
+
+    def fast_preview_size(self, full_size, screen, thumbnail_size):
+        """Size of the fast preview pass: the display's, scaled to what this machine can render in time"""
+        def size_at(scale):
+            if scale >= 1.0:
+                return None if screen == tuple(full_size) else screen
+            return fit_size(full_size, (screen[0] * scale, screen[1] * scale))
+
+        # The thumbnail and this pass should both fit in the frame budget
+        # (see PREVIEW_FRAME_BUDGET_MS). Render time goes roughly with pixel
+        # count when stepping down; stepping up can cross into a bigger
+        # pyramid level, so that goes by the next size's own (or nearest)
+        # measurement
+        budget = PREVIEW_FRAME_BUDGET_MS / 1000
+        budget -= self.render_times.estimate(thumbnail_size or full_size, PREVIEW_COLOR_LUT) or 0
+        cost = self.render_times.estimate(size_at(self.preview_scale) or full_size, PREVIEW_COLOR_LUT)
+        if cost is not None:
+            if cost > budget:
+                steps = math.ceil(math.log(cost / max(budget, 1e-3), PREVIEW_SCALE_STEP ** 2))
+                self.preview_scale = max(PREVIEW_SCALE_MIN, self.preview_scale / PREVIEW_SCALE_STEP ** steps)
+            elif self.preview_scale < 1.0:
+                larger = size_at(self.preview_scale * PREVIEW_SCALE_STEP) or full_size
+                if self.render_times.estimate(larger, PREVIEW_COLOR_LUT) < budget:
+                    self.preview_scale = min(1.0, self.preview_scale * PREVIEW_SCALE_STEP)
+        return size_at(self.preview_scale)
+
+    def request_tiles(self, keys, display_size):
+        """Render the given view tiles of the current frame, nearest the centre first"""
+        source, params, color_lut, stats = self.frame_render
+        pyramid = self.pyramid if self.pyramid is not None and self.pyramid.image is source else None
+        fw, fh = self.frame_size
+        dw, dh = display_size
+        tile = VIEW_TILE_SIZE
+        s = self.view_scale()
+        cx, cy = self.view_center[0] * s, self.view_center[1] * s
+        keys = sorted(keys, key=lambda k: (k[-2] * tile - cx) ** 2 + (k[-1] * tile - cy) ** 2)
+
+        def job(superseded):
+            for key in keys:
+                i, j = key[-2:]
+                box = (i * tile, j * tile, min((i + 1) * tile, dw), min((j + 1) * tile, dh))
+                crop = (box[0] * fw / dw, box[1] * fh / dh, box[2] * fw / dw, box[3] * fh / dh)
+                # The frame's stats keep contrast and auto contrast seamless across tiles
+                im = self.apply_filters_to(source, color_lut, (box[2] - box[0], box[3] - box[1]),
+                                           params, cancel=superseded.is_set, pyramid=pyramid,
+                                           crop=crop, stats=dict(stats))
+                yield "tile", (key, im)
+
+        self.render_worker.submit(job)
+        self.tiles_requested = set(keys)
+        self.watch_render()
+
+    def resample_frame(self, pyramid, size):
+        """Full-resolution frame scaled to size, from its nearest pyramid level (off the Tk thread)"""
+        return pyramid.level_for(size).resize(size, Image.Resampling.LANCZOS)
+
+    def request_display_frame(self, size):
+        """Have the render worker scale the full-resolution frame to the display size"""
+        if self.frame_pyramid is None or self.frame_pyramid.image is not self.frame:
+            self.frame_pyramid = Pyramid(self.frame)
+        pyramid, frame_id = self.frame_pyramid, self.frame_id
+
+        def job(superseded):
+            yield "display", (frame_id, size, self.resample_frame(pyramid, size))
+
+        self.render_worker.submit(job)
+        self.display_requested = (frame_id, size)
+        self.watch_render()
+
+    def watch_render(self):
+        if self._poll_id is None:
+            self._poll_id = self.root.after(RENDER_POLL_MS, self.poll_render)
+
+    def poll_render(self):
+        self._poll_id = None
+        frame = None
+        tiles = False
+        for _, value, error in self.render_worker.poll():
+            if error is not None:
+                self.frame_pending = False
+                self.status_label.config(text=f"Failed to apply filters: {error}")
+            elif value[0] == "frame":
+                frame = value[1]
+            elif value[0] == "display":
+                frame_id, size, im = value[1]
+                self.display_requested = None
+                if frame_id == self.frame_id:
+                    self.store_display_frame((frame_id, size, None, Image.Resampling.LANCZOS), im)
+                    tiles = True
+            else:
+                key, im = value[1]
+                self.tiles_requested.discard(key)
+                self.view_tiles[key] = ImageTk.PhotoImage(im)
+                while len(self.view_tiles) > VIEW_TILE_CACHE:
+                    self.view_tiles.popitem(last=False)
+                tiles = True
+        if frame is not None:
+            self.image, full_size, render_info, final, status_text, shown = frame
+            if final:
+                self.frame_pending = False
+            self.display_image(self.image, full_size, render_info, final, shown)
+            self.status_label.config(text=status_text)
+        elif tiles:
+            self.redraw()
+        if self.render_worker.busy():
+            self._poll_id = self.root.after(RENDER_POLL_MS, self.poll_render)
+
+    def get_filter_params(self):
+        """Snapshot the current slider/toggle state (must run on the Tk thread)"""
+        return FilterParams(
+            grayscale=self.grayscale_var.get(),
+            blur=self.blur_var.get(),
+            contrast=self.contrast_var.get(),
+            brightness=self.brightness_var.get(),
+            sharpen=self.sharpen_var.get(),
+            saturation=self.saturation_var.get(),
+            edge_enhance=self.edge_enhance_var.get(),
+            rotation=self.rotation_var.get(),
+            sepia=self.sepia_var.get(),
+            posterize=self.posterize_var.get(),
+            emboss_intensity=self.emboss_intensity_var.get(),
+            hue_shift=self.hue_shift_var.get(),
+            noise_reduction_size=self.noise_reduction_size_var.get(),
+            invert=self.invert_active,
+            flip_horizontal=self.flip_horizontal_active,
+            flip_vertical=self.flip_vertical_active,
+            auto_contrast=self.auto_contrast_active,
+        )
 
-            # Fit inside canvas keeping aspect ratio with zoom
-            if display_width > canvas_width or display_height > canvas_height:
-                scale = min(canvas_width / display_width, canvas_height / display_height)
-                display_width = int(display_width * scale)
-                display_height = int(display_height * scale)
-                self.zoom_level *= scale
+    def source_pyramid(self, image):
+        """Pyramid of image, started afresh whenever the source changes"""
+        if self.pyramid is None or self.pyramid.image is not image:
+            self.pyramid = Pyramid(image)
+            self.view_tiles.clear()
+        return self.pyramid
+
+    def apply_filters_to(self, im, color_lut=0, size=None, params=None, cancel=None, pyramid=None,
+                         crop=None, stats=None):
+        # Pass the same image object each time for cache hits; the result is read-only.
+        # Off the Tk thread, pass params snapshotted with get_filter_params().
+        if params is None:
+            params = self.get_filter_params()
+        return render(im, params, cache=self.stage_cache,
+                      fuse=True, lut=True, color_lut=color_lut, size=size,
+                      workers=RENDER_WORKERS, cancel=cancel, pyramid=pyramid, crop=crop,
+                      stats=stats)
+
+    def display_image(self, image, full_size=None, render_info=None, final=True, shown=None):
+        # full_size: the size of the full-resolution frame a preview stands in for;
+        # render_info: (source, params, colour LUT, stats) it was rendered with,
+        # unless the image is an unfiltered source itself; shown: (pyramid,
+        # display size, resampled image) of a full-resolution frame
+        if image:
+            self.frame = image
+            self.frame_id += 1
+            self.frame_size = full_size or image.size
+            self.frame_render = render_info or (image, FilterParams(), 0, {})
+            self.frame_final = final
+            self.frame_pyramid = None
+            if shown is not None:
+                self.frame_pyramid, size, resized_image = shown
+                self.store_display_frame((self.frame_id, size, None, Image.Resampling.LANCZOS),
+                                         resized_image)
+            self.redraw()
+
+    def view_scale(self, size=None):
+        """Screen pixels per full-resolution pixel at the current zoom"""
+        fw, fh = size or self.frame_size
+        fit = min(1.0, self.canvas.winfo_width() / fw, self.canvas.winfo_height() / fh)
+        return fit * self.zoom_level
+
+    def display_size(self, size=None):
+        """On-screen size of a full-resolution image of this size at the current zoom"""
+        fw, fh = size or self.frame_size
+        s = self.view_scale((fw, fh))
+        return max(1, round(fw * s)), max(1, round(fh * s))
+
+    def redraw(self):
+        """Lay the frame out on the canvas: whole if it fits at the current zoom,
+        otherwise just the visible part, with rendered tiles over it"""
+        if not self.frame:
+            return
+        canvas_width = self.canvas.winfo_width()
+        canvas_height = self.canvas.winfo_height()
+        fw, fh = self.frame_size
+        s = self.view_scale()
+        display_width, display_height = self.display_size()
+
+        # Mid-gesture, anything goes as long as it's quick
+        gesture = self._gesture_id is not None
+        if display_width <= canvas_width and display_height <= canvas_height:
+            self.view_center = None
+            self.clear_tile_items()
+            image = self.frame
+            display = (display_width, display_height)
+            resample = Image.Resampling.BILINEAR if gesture else Image.Resampling.LANCZOS
+            if self.pyramid is not None and image is self.pyramid.image:
+                # Showing the source itself: start from the nearest pyramid level
+                image = self.pyramid.level_for(display)
+            elif image.size == tuple(self.frame_size) != display and not gesture \
+                    and (self.frame_id, display, None, resample) not in self.display_frames:
+                # A full-resolution frame: stand in for its proper resampling
+                # until the render worker has done that (unless a new frame
+                # is on its way anyway; an idle worker has dropped the request)
+                resample = Image.Resampling.BILINEAR
+                if self.frame_final and not self.frame_pending and (
+                        self.display_requested != (self.frame_id, display)
+                        or not self.render_worker.busy()):
+                    self.request_display_frame(display)
+            resized_image = self.display_frame(image, display, None, resample)
+            self.show_frame(resized_image, canvas_width // 2, canvas_height // 2, "center")
+            return
 
-            resized_image = image.resize((display_width, display_height), Image.Resampling.LANCZOS)
+        # Keep the view on the image, centring any axis that fits
+        cx, cy = self.view_center or (fw / 2, fh / 2)
+        half_w, half_h = canvas_width / 2 / s, canvas_height / 2 / s
+        cx = fw / 2 if display_width <= canvas_width else min(max(cx, half_w), fw - half_w)
+        cy = fh / 2 if display_height <= canvas_height else min(max(cy, half_h), fh - half_h)
+        self.view_center = (cx, cy)
+        # Display pixel at the canvas origin, and the visible part of the display
+        ox, oy = round(cx * s - canvas_width / 2), round(cy * s - canvas_height / 2)
+        x0, y0 = max(0, ox), max(0, oy)
+        x1, y1 = min(display_width, ox + canvas_width), min(display_height, oy + canvas_height)
+
+        # The frame itself, stretched over the view until the tiles arrive; a
+        # full-resolution frame already has all the detail there is
+        full_res = self.frame.size == tuple(self.frame_size)
+        fx, fy = self.frame.width / display_width, self.frame.height / display_height
+        resample = Image.Resampling.LANCZOS if full_res and not gesture else Image.Resampling.BILINEAR
+        visible = self.display_frame(self.frame, (x1 - x0, y1 - y0),
+                                     (x0 * fx, y0 * fy, x1 * fx, y1 * fy), resample)
+        self.show_frame(visible, x0 - ox, y0 - oy, "nw")
+        if full_res:
+            self.clear_tile_items()
+            return
 
-            self.photo = ImageTk.PhotoImage(resized_image)
+        source, params, color_lut, _ = self.frame_render
+        tile = VIEW_TILE_SIZE
+        wanted = {(id(source), params, color_lut, s, i, j)
+                  for j in range(y0 // tile, (y1 - 1) // tile + 1)
+                  for i in range(x0 // tile, (x1 - 1) // tile + 1)}
+        for key in [key for key in self.tile_items if key not in wanted]:
+            self.canvas.delete(self.tile_items.pop(key))
+        missing = []
+        for key in wanted:
+            photo = self.view_tiles.get(key)
+            if photo is None:
+                missing.append(key)
+                continue
+            self.view_tiles.move_to_end(key)
+            x, y = key[-2] * tile - ox, key[-1] * tile - oy
+            if key in self.tile_items:
+                self.canvas.coords(self.tile_items[key], x, y)
+            else:
+                self.tile_items[key] = self.canvas.create_image(x, y, image=photo, anchor="nw")
+        # Only once the frame (and its stats) are final, not while a new frame
+        # is on its way, and not mid-gesture, when the view is still moving
+        if missing and self.frame_final and not self.frame_pending and not gesture \
+                and not set(missing) <= self.tiles_requested:
+            self.request_tiles(missing, (display_width, display_height))
+
+    def display_frame(self, image, size, box, resample):
+        """`box` of the current frame's image resized to size"""
+        if box is None and image.size == size:
+            # Rendered at display size already
+            return image
+        key = (self.frame_id, size, box, resample)
+        resized_image = self.display_frames.get(key)
+        if resized_image is not None:
+            self.display_frames.move_to_end(key)
+            return resized_image
+        if resample == Image.Resampling.LANCZOS:
+            resized_image = image.resize(size, resample, box=box)
+        else:
+            # Cheap: let Pillow box-reduce most of the way first
+            resized_image = image.resize(size, resample, box=box, reducing_gap=1.0)
+        self.store_display_frame(key, resized_image)
+        return resized_image
+
+    def store_display_frame(self, key, image):
+        self.display_frames[key] = image
+        while len(self.display_frames) > DISPLAY_FRAME_CACHE:
+            self.display_frames.popitem(last=False)
+
+    def show_frame(self, image, x, y, anchor):
+        if self.photo is None or (self.photo.width(), self.photo.height()) != image.size:
+            self.photo = ImageTk.PhotoImage(image)
             if self.canvas_image is None:
-                self.canvas_image = self.canvas.create_image(canvas_width//2, canvas_height//2, image=self.photo, anchor="center")
+                self.canvas_image = self.canvas.create_image(x, y, image=self.photo, anchor=anchor)
             else:
                 self.canvas.itemconfig(self.canvas_image, image=self.photo)
+        elif image is not self.photo_source:
+            # Same size: copy the pixels into the Tk image already on the canvas
+            self.photo.paste(image)
+        self.photo_source = image
+        self.canvas.coords(self.canvas_image, x, y)
+        self.canvas.itemconfig(self.canvas_image, anchor=anchor)
+
+    def clear_tile_items(self):
+        for item in self.tile_items.values():
+            self.canvas.delete(item)
+        self.tile_items.clear()
+
+    def gesture(self):
+        """Redraw cheaply now, and properly once the resize/zoom/pan has settled"""
+        if self._gesture_id is not None:
+            self.root.after_cancel(self._gesture_id)
+        self._gesture_id = self.root.after(GESTURE_SETTLE_MS, self.end_gesture)
+        self.redraw()
+
+    def end_gesture(self):
+        self._gesture_id = None
+        self.redraw()
+        # A preview fitted to the canvas was rendered for the old display
+        # size; render it again for the new one (an exact full-resolution
+        # frame stays as it is)
+        if not self.frame or self.view_center is not None:
+            return
+        exact = not self.fast_preview.get() and self.frame.size == tuple(self.frame_size)
+        if not exact and self.display_size() != self.render_screen:
+            self.schedule_apply()
 
     def on_canvas_resize(self, event):
-        if self.image:
-            self.display_image(self.image)
+        if self.frame:
+            self.gesture()
 
     def on_mouse_wheel(self, event):
-        if not self.image:
+        if not self.frame:
             return
+        # Zoom about the point under the cursor
+        canvas_width = self.canvas.winfo_width()
+        canvas_height = self.canvas.winfo_height()
+        s = self.view_scale()
+        cx, cy = self.view_center or (self.frame_size[0] / 2, self.frame_size[1] / 2)
+        px = cx + (event.x - canvas_width / 2) / s
+        py = cy + (event.y - canvas_height / 2) / s
         if event.num == 5 or event.delta < 0:  # scroll down = zoom out
-            self.zoom_level = max(0.1, self.zoom_level - 0.1)
+            self.zoom_level = max(0.1, self.zoom_level / ZOOM_STEP)
         elif event.num == 4 or event.delta > 0:  # scroll up = zoom in
-            self.zoom_level = min(5.0, self.zoom_level + 0.1)
-        self.display_image(self.image)
+            self.zoom_level = min(MAX_PIXEL_ZOOM * self.zoom_level / s, self.zoom_level * ZOOM_STEP)
+        s = self.view_scale()
+        self.view_center = (px - (event.x - canvas_width / 2) / s, py - (event.y - canvas_height / 2) / s)
+        self.gesture()
+
+    def on_pan_start(self, event):
+        self._pan_from = (event.x, event.y)
+
+    def on_pan(self, event):
+        if self.view_center is None or self._pan_from is None:
+            return
+        s = self.view_scale()
+        x0, y0 = self._pan_from
+        self._pan_from = (event.x, event.y)
+        cx, cy = self.view_center
+        self.view_center = (cx - (event.x - x0) / s, cy - (event.y - y0) / s)
+        self.gesture()
 
     def toggle_invert(self):
         self.invert_active = not self.invert_active
@@ -481,8 +916,7 @@ class ImageProcessorApp:
         try:
             res_str = self.resolution_var.get()
             width, height = map(int, res_str.split()[0].split('x'))
-            self.push_undo()
-            self.original_image = self.original_image.resize((width, height), Image.Resampling.LANCZOS)
+            self.edit_image(("resize", (width, height)))
             self.schedule_apply()
             self.status_label.config(text=f"Resized image to {res_str}")
         except Exception as e:
@@ -498,8 +932,7 @@ class ImageProcessorApp:
             top = int(height * 0.25)
             right = int(width * 0.75)
             bottom = int(height * 0.75)
-            self.push_undo()
-            self.original_image = self.original_image.crop((left, top, right, bottom))
+            self.edit_image(("crop", (left, top, right, bottom)))
             self.schedule_apply()
             self.status_label.config(text="Cropped image to center")
         except Exception as e:
@@ -512,37 +945,46 @@ class ImageProcessorApp:
                                 filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg")])
         if save_path:
             try:
-                im = self.apply_filters_to(self.original_image.copy())
+                im = self.apply_filters_to(self.original_image)
                 im.save(save_path)
                 self.status_label.config(text=f"Saved image to {os.path.basename(save_path)}")
                 messagebox.showinfo("Success", "Image saved successfully!")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to save image: {e}")
 
-    def push_undo(self):
-        if self.original_image:
-            self.undo_stack.append(self.original_image.copy())
-            if len(self.undo_stack) > 20:  # Limit undo history
-                self.undo_stack.pop(0)
+    def edit_image(self, op):
+        """Apply a destructive operation (see history.apply_op) and log it for undo"""
+        self.original_image = apply_op(self.original_image, op)
+        self.history.record(op, self.original_image)
 
     def undo(self):
-        if self.undo_stack:
-            self.redo_stack.append(self.original_image.copy())
-            self.original_image = self.undo_stack.pop()
+        im = self.history.undo()
+        if im is not None:
+            self.original_image = im
             self.schedule_apply()
             self.status_label.config(text="Undo applied")
 
     def redo(self):
-        if self.redo_stack:
-            self.undo_stack.append(self.original_image.copy())
-            self.original_image = self.redo_stack.pop()
+        im = self.history.redo()
+        if im is not None:
+            self.original_image = im
             self.schedule_apply()
             self.status_label.config(text="Redo applied")
 
+    def begin_drag(self, event=None):
+        self.dragging = True
+
+    def end_drag(self, event=None):
+        self.dragging = False
+        if self.drag_proxy_shown:
+            self.drag_proxy_shown = False
+            self.schedule_apply()
+
     def on_preview_toggle(self):
         if self.preview_enabled.get():
             self.schedule_apply()
         else:
+            self.render_worker.cancel()
             if self.original_image:
                 self.display_image(self.original_image)
                 self.status_label.config(text="Preview disabled")
@@ -551,27 +993,9 @@ class ImageProcessorApp:
         if self.preview_enabled.get():
             self.schedule_apply()
 
-    def apply_sepia(self, img):
-        arr = np.array(img).astype(np.float32)
-        r, g, b = arr[:,:,0], arr[:,:,1], arr[:,:,2]
-        tr = 0.393 * r + 0.769 * g + 0.189 * b
-        tg = 0.349 * r + 0.686 * g + 0.168 * b
-        tb = 0.272 * r + 0.534 * g + 0.131 * b
-        sepia_arr = np.stack([tr, tg, tb], axis=2)
-        sepia_arr = np.clip(sepia_arr, 0, 255).astype(np.uint8)
-        return Image.fromarray(sepia_arr)
-
-    def shift_hue(self, img, hue_shift):
-        """Shift hue by given degrees"""
-        hsv = img.convert('HSV')
-        np_hsv = np.array(hsv)
-        # hue_shift expected in degrees, convert to 0-255 range
-        shift = int((hue_shift / 360.0) * 255)
-        np_hsv[...,0] = ((np_hsv[...,0].astype(np.int16) + shift) % 256).astype(np.uint8)
-        shifted = Image.fromarray(np_hsv, 'HSV').convert('RGB')
-        return shifted
-
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["batch"]:
+        sys.exit(batch.main(sys.argv[2:]))
     root = tk.Tk()
     app = ImageProcessorApp(root)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,127 @@
+"""Background rendering for the live preview.
+
+Nothing in here touches Tk either: the GUI snapshots what it needs on the
+Tk thread, submits a job and picks the result up from a root.after poll.
+"""
+import math
+import threading
+import time
+
+
+class RenderWorker:
+    """Runs preview jobs on one background thread, newest first.
+
+    A job is a callable taking a threading.Event and returning an iterable
+    of results, e.g. progressively finer renders; each one is published as
+    it is produced. submit() sets the event of the job before it and drops
+    it if it hasn't started yet, so a burst of slider moves only renders the
+    latest snapshot rather than queueing up behind a slow chain. Jobs should
+    stop early once their event is set (pass its is_set as render()'s
+    cancel, or wait() on it to pause); whatever they produce after that is
+    thrown away. Every job gets an increasing generation number; poll()
+    hands back the results that haven't been collected yet, oldest first.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._superseded = None  # Event of the newest job
+        self._pending = None  # (generation, job, event) not started yet
+        self._running = False
+        self._results = []  # (generation, value, error) not collected yet
+        threading.Thread(target=self._run, name="render-worker", daemon=True).start()
+
+    def submit(self, job):
+        """Schedule job(superseded) to run, cancelling any earlier one; returns its generation"""
+        with self._cond:
+            self.cancel()
+            self._generation += 1
+            self._superseded = threading.Event()
+            self._pending = (self._generation, job, self._superseded)
+            self._cond.notify()
+            return self._generation
+
+    def cancel(self):
+        """Stop the current job and drop any pending or uncollected results"""
+        with self._cond:
+            if self._superseded is not None:
+                self._superseded.set()
+            self._pending = None
+            self._results = []
+
+    def poll(self):
+        """List of (generation, value, error) published since the last poll"""
+        with self._cond:
+            results, self._results = self._results, []
+            return results
+
+    def busy(self):
+        """Whether a job is pending, running or has results waiting to be collected"""
+        with self._cond:
+            return self._pending is not None or self._running or bool(self._results)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                generation, job, superseded = self._pending
+                self._pending = None
+                self._running = True
+            try:
+                for value in job(superseded):
+                    self._publish(superseded, (generation, value, None))
+                    if superseded.is_set():
+                        break
+            except Exception as e:
+                # Includes engine.Cancelled, which is only raised once superseded
+                self._publish(superseded, (generation, None, e))
+            with self._cond:
+                self._running = False
+
+    def _publish(self, superseded, result):
+        with self._cond:
+            if not superseded.is_set():
+                self._results.append(result)
+
+
+class RenderTimes:
+    """Moving average of how long preview renders take, by output resolution.
+
+    Renders are bucketed by pixel count in half-octave steps, and by colour
+    LUT grid since that changes the cost per pixel. estimate() falls back
+    on the nearest bucket measured so far, scaled by pixel count, and
+    returns None before anything has been measured at that LUT setting.
+    Measurements older than max_age seconds are ignored, so a resolution
+    that stopped being rendered because it was slow gets tried again once
+    the settings may have changed. Thread-safe: the render worker records,
+    the Tk thread asks.
+    """
+    def __init__(self, weight=0.3, max_age=10.0):
+        self.weight = weight
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._times = {}  # (bucket, color_lut) -> (seconds, when measured)
+
+    @staticmethod
+    def _bucket(size):
+        return round(2 * math.log2(max(size[0] * size[1], 1)))
+
+    def record(self, size, color_lut, seconds):
+        key = (self._bucket(size), color_lut)
+        now = time.monotonic()
+        with self._lock:
+            previous = self._times.get(key)
+            if previous is not None and now - previous[1] <= self.max_age:
+                seconds = previous[0] + self.weight * (seconds - previous[0])
+            self._times[key] = (seconds, now)
+
+    def estimate(self, size, color_lut):
+        bucket = self._bucket(size)
+        oldest = time.monotonic() - self.max_age
+        with self._lock:
+            known = [(abs(b - bucket), b, t) for (b, lut), (t, when) in self._times.items()
+                     if lut == color_lut and when >= oldest]
+        if not known:
+            return None
+        _, b, seconds = min(known)
+        return seconds * 2 ** ((bucket - b) / 2)
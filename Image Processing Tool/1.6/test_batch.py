@@ -0,0 +1,60 @@
+"""Checks for batch.py; run with python -m pytest from this folder."""
+from batch import Pipeline, load_params
+from engine import FilterParams
+import pytest
+import random
+import threading
+import time
+
+
+def test_pipeline_isolates_errors():
+    # Several workers per stage, so every one of them must get its stop
+    # signal and the run still ends; a failure skips only its own item
+    calls = []
+    lock = threading.Lock()
+
+    def stage(fail_on):
+        def function(name, value):
+            with lock:
+                calls.append((fail_on, name))
+            time.sleep(random.random() / 1000)
+            if name % fail_on == 0:
+                raise ValueError(f"{name} failed")
+            return (value or 0) + 1
+        return function
+
+    # Stage i fails on multiples of fail_on[i]
+    fail_on = (7, 5, 11)
+    names = list(range(1, 101))
+    results = []
+    pipeline = Pipeline([(stage(n), workers) for n, workers in zip(fail_on, (3, 2, 4))])
+    runner = threading.Thread(target=lambda: results.extend(pipeline.run(names)), daemon=True)
+    runner.start()
+    runner.join(30)
+    assert not runner.is_alive()
+
+    assert sorted(name for name, _, _ in results) == names
+    for name, value, error in results:
+        ran = [n for n, called in calls if called == name]
+        failed = [n for n in fail_on if name % n == 0]
+        if failed:
+            assert value is None and str(error) == f"{name} failed"
+            assert ran == list(fail_on[:fail_on.index(failed[0]) + 1])
+        else:
+            assert (value, error) == (3, None)
+            assert ran == list(fail_on)
+
+
+def test_load_params_checks_types(tmp_path):
+    path = tmp_path / "settings.json"
+    path.write_text('{"contrast": 2, "posterize": 3.0, "invert": true}')
+    params = load_params(path)
+    assert params == FilterParams(contrast=2.0, posterize=3, invert=True)
+    assert type(params.contrast) is float and type(params.posterize) is int
+
+    for settings in ['{"contrast": "a"}', '{"invert": "false"}', '{"invert": 0}',
+                     '{"flip_vertical": null}', '{"posterize": 2.5}', '{"posterize": true}',
+                     '{"rotation": Infinity}', '{"sharpen": [1]}', '[]']:
+        path.write_text(settings)
+        with pytest.raises(ValueError):
+            load_params(path)
@@ -0,0 +1,197 @@
+"""Checks for engine.py; run with python -m pytest from this folder."""
+from dataclasses import fields, replace
+from PIL import Image
+from engine import COLOR_LUT_TOLERANCE, STAGES, ColorCube, FilterParams, StageCache, plan, render
+import numpy as np
+import random
+
+
+def _display_size(size, box):
+    # As ImageProcessorApp.display_size: fit inside box, each side rounded
+    scale = min(1.0, box[0] / size[0], box[1] / size[1])
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def test_display_size_render_resamples_once(monkeypatch):
+    calls = []
+    resize = Image.Image.resize
+
+    def spy(self, *args, **kwargs):
+        calls.append(args)
+        return resize(self, *args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, "resize", spy)
+    rng = random.Random(0)
+    sizes = [((3001, 1999), (1000, 666))]
+    for _ in range(100):
+        size = (rng.randint(50, 2000), rng.randint(50, 2000))
+        sizes.append((size, _display_size(size, (rng.randint(100, 1200), rng.randint(100, 800)))))
+    for size, display in sizes:
+        if display == size:
+            continue
+        calls.clear()
+        out = render(Image.new("RGB", size), FilterParams(saturation=1.2), size=display)
+        assert out.size == display
+        assert len(calls) == 1, (size, display, calls)
+
+
+def _random_params(rng):
+    return FilterParams(
+        grayscale=rng.choice([0, rng.uniform(0, 1)]),
+        blur=rng.choice([0, rng.uniform(0, 3)]),
+        contrast=rng.choice([1, rng.uniform(0.5, 2)]),
+        brightness=rng.choice([1, rng.uniform(0.5, 2)]),
+        sharpen=rng.choice([0, rng.uniform(0, 3)]),
+        saturation=rng.choice([1, rng.uniform(0, 2)]),
+        edge_enhance=rng.choice([0, rng.uniform(0, 2)]),
+        rotation=rng.choice([0, 90, 180, 270, -90, round(rng.uniform(-180, 180), 1)]),
+        sepia=rng.choice([0, rng.uniform(0, 1)]),
+        posterize=rng.choice([8, rng.randint(1, 7)]),
+        emboss_intensity=rng.choice([0, rng.randint(1, 3)]),
+        hue_shift=rng.choice([0, rng.randint(-180, 180)]),
+        noise_reduction_size=rng.choice([1, 3, 5]),
+        invert=rng.random() < 0.3,
+        flip_horizontal=rng.random() < 0.5,
+        flip_vertical=rng.random() < 0.5,
+        auto_contrast=rng.random() < 0.3,
+    )
+
+
+def _rotate_then_flip(im, params):
+    im = im.rotate(-params.rotation, expand=True, resample=Image.Resampling.BICUBIC)
+    if params.flip_horizontal:
+        im = im.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    if params.flip_vertical:
+        im = im.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    return im
+
+
+def _test_image(size):
+    # Texture everywhere, so a different rounding shows up somewhere
+    return Image.merge("RGB", [Image.effect_noise(size, sigma) for sigma in (40, 60, 80)])
+
+
+def test_geometry_matches_rotate_then_flip():
+    # Odd sizes and arbitrary angles are where folding the flips into the
+    # rotation's matrix used to round differently
+    rng = random.Random(0)
+    cases = [((225, 367), -29.7, True, True)]
+    for _ in range(150):
+        cases.append(((rng.randint(20, 300), rng.randint(20, 300)),
+                      rng.choice([round(rng.uniform(-180, 180), 1), 45.5, 90, 180]),
+                      rng.random() < 0.5, rng.random() < 0.5))
+    for size, rotation, flip_horizontal, flip_vertical in cases:
+        im = _test_image(size)
+        params = FilterParams(rotation=rotation, flip_horizontal=flip_horizontal,
+                              flip_vertical=flip_vertical)
+        assert render(im, params).tobytes() == _rotate_then_flip(im, params).tobytes(), params
+
+
+def test_chain_matches_original_order():
+    # The GUI's original order: rotate(), the other filters, then the flips
+    # (auto contrast, which came after them, doesn't care about mirroring)
+    rng = random.Random(1)
+    for _ in range(200):
+        im = _test_image((rng.randint(40, 160), rng.randint(40, 160)))
+        params = _random_params(rng)
+        rotated = _rotate_then_flip(im, replace(params, flip_horizontal=False, flip_vertical=False))
+        expected = render(rotated, replace(params, rotation=0, flip_horizontal=False,
+                                           flip_vertical=False))
+        expected = _rotate_then_flip(expected, replace(params, rotation=0))
+        for fast in (False, True):
+            out = render(im, params, fuse=fast, lut=fast)
+            assert out.tobytes() == expected.tobytes(), (params, fast)
+
+
+def test_tiles_reuse_frame_statistics():
+    # The frame is small enough to scale the median away, which lets invert
+    # merge into the contrast's tone curve; full-resolution tiles keep the
+    # median, so their merged steps differ but the contrast mean must not
+    im = Image.merge("RGB", [Image.linear_gradient("L").resize((600, 400))] * 3)
+    params = FilterParams(contrast=2.5, noise_reduction_size=3, invert=True)
+    stats = {}
+    render(im, params, fuse=True, lut=True, size=(150, 100), stats=stats)
+    expected = render(im, params, fuse=True, lut=True, stats=dict(stats))
+    for box in [(0, 0, 128, 128), (300, 200, 428, 328), (472, 272, 600, 400)]:
+        tile_stats = dict(stats)
+        tile = render(im, params, fuse=True, lut=True, crop=box, stats=tile_stats)
+        assert tile_stats == stats
+        assert tile.tobytes() == expected.crop(box).tobytes(), box
+
+
+def test_tiled_render_caches_every_step(monkeypatch):
+    # Threads tile the chain; changing a later filter must still pick the
+    # blur up from the cache rather than tile it all over again
+    blur = next(stage for stage in STAGES if stage.name == "blur")
+    calls = []
+    apply = blur.apply
+
+    def spy(*args):
+        calls.append(args)
+        return apply(*args)
+
+    monkeypatch.setattr(blur, "apply", spy)
+    im = _test_image((300, 200))
+    cache = StageCache()
+    params = FilterParams(blur=2, sharpen=1, saturation=1.5)
+    render(im, params, cache=cache, tile_size=64, workers=2)
+    assert calls
+    calls.clear()
+    out = render(im, replace(params, saturation=0.5), cache=cache, tile_size=64, workers=2)
+    assert not calls
+    assert out.tobytes() == render(im, replace(params, saturation=0.5)).tobytes()
+
+
+def test_tiled_render_matches_whole():
+    rng = random.Random(2)
+    for _ in range(60):
+        im = _test_image((rng.randint(20, 90), rng.randint(20, 90)))
+        params = _random_params(rng)
+        fast = rng.random() < 0.5
+        expected = render(im, params, fuse=fast, lut=fast)
+        for tile_size, workers in [(rng.choice([5, 7, 13, 31]), 1), (rng.choice([9, 17]), 3)]:
+            out = render(im, params, fuse=fast, lut=fast, tile_size=tile_size, workers=workers)
+            assert out.tobytes() == expected.tobytes(), (params, fast, tile_size, workers)
+
+
+def test_cached_render_matches_uncached():
+    # One slider at a time, as in the GUI, so each render picks up a prefix
+    rng = random.Random(3)
+    im = _test_image((97, 61))
+    for fast, tile_size in [(False, None), (True, None), (True, 23)]:
+        cache = StageCache()
+        params = FilterParams()
+        for _ in range(60):
+            field = rng.choice(fields(FilterParams)).name
+            params = replace(params, **{field: getattr(_random_params(rng), field)})
+            out = render(im, params, cache=cache, fuse=fast, lut=fast, tile_size=tile_size)
+            expected = render(im, params, fuse=fast, lut=fast)
+            assert out.tobytes() == expected.tobytes(), (params, fast, tile_size)
+
+
+def test_color_lut_falls_back_to_exact():
+    im = _test_image((80, 60))
+    params = FilterParams(saturation=1.5, posterize=2)
+    cube = next(step for step in plan(params, color_lut=18) if isinstance(step, ColorCube))
+    assert cube.build(params, None)[1] > COLOR_LUT_TOLERANCE
+    out = render(im, params, color_lut=18)
+    assert out.tobytes() == render(im, params, fuse=True).tobytes()
+
+    # Within tolerance, the cube itself is used
+    params = FilterParams(saturation=1.5, sepia=0.3)
+    out = np.asarray(render(im, params, color_lut=18), dtype=int)
+    assert np.abs(out - np.asarray(render(im, params), dtype=int)).max() <= COLOR_LUT_TOLERANCE
+
+
+def test_crop_matches_render_then_crop():
+    # With the frame's statistics, as the GUI's view tiles get them
+    rng = random.Random(4)
+    for _ in range(100):
+        im = _test_image((rng.randint(30, 120), rng.randint(30, 120)))
+        params = _random_params(rng)
+        stats = {}
+        whole = render(im, params, stats=stats)
+        x0, y0 = rng.randrange(whole.width - 1), rng.randrange(whole.height - 1)
+        box = (x0, y0, rng.randint(x0 + 1, whole.width), rng.randint(y0 + 1, whole.height))
+        out = render(im, params, crop=box, stats=dict(stats))
+        assert out.tobytes() == whole.crop(box).tobytes(), (params, box)
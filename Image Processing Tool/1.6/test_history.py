@@ -0,0 +1,97 @@
+"""Checks for history.py; run with python -m pytest from this folder."""
+from PIL import Image
+from history import History, SnapshotStore, apply_op
+import random
+import time
+
+
+def _test_image(size):
+    return Image.merge("RGB", [Image.effect_noise(size, sigma) for sigma in (40, 60, 80)])
+
+
+def _random_op(rng, im):
+    w, h = im.size
+    if rng.random() < 0.5 and w > 8 and h > 8:
+        x0, y0 = rng.randrange(w // 4), rng.randrange(h // 4)
+        return "crop", (x0, y0, rng.randint(x0 + 4, w), rng.randint(y0 + 4, h))
+    return "resize", (rng.randint(20, 90), rng.randint(20, 90))
+
+
+def _settle(store):
+    # Wait for the background thread to compress (and so spill) everything
+    deadline = time.monotonic() + 30
+    while any(entry.image is not None for entry in store._entries.values()):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_history_matches_reference(monkeypatch):
+    # A RAM budget of one byte sends every compressed keyframe to the
+    # scratch file, and the discards on each new branch compact it
+    compactions = []
+    compact = SnapshotStore._compact
+
+    def spy(self):
+        file_bytes = self._file_bytes
+        compact(self)
+        if self._file_bytes < file_bytes:
+            compactions.append(file_bytes)
+
+    monkeypatch.setattr(SnapshotStore, "_compact", spy)
+    rng = random.Random(0)
+    store = SnapshotStore(ram_bytes=1)
+    history = History(max_bytes=1 << 30, store=store)
+    states = [_test_image((64, 48))]
+    position = 0
+    history.reset(states[0])
+    for step in range(400):
+        action = rng.random()
+        if action < 0.3:
+            op = _random_op(rng, states[position])
+            im = apply_op(states[position], op)
+            history.record(op, im)
+            del states[position + 1:]
+            states.append(im)
+            position += 1
+        elif action < 0.75:
+            im = history.undo()
+            if position == 0:
+                assert im is None
+            else:
+                position -= 1
+                assert im.tobytes() == states[position].tobytes(), step
+        else:
+            im = history.redo()
+            if position == len(states) - 1:
+                assert im is None
+            else:
+                position += 1
+                assert im.tobytes() == states[position].tobytes(), step
+        assert history.can_undo() == (position > 0)
+        assert history.can_redo() == (position < len(states) - 1)
+        _settle(store)
+    assert compactions
+
+
+def test_trim_drops_redo_only_keyframes_first():
+    rng = random.Random(1)
+    store = SnapshotStore(ram_bytes=1)
+    history = History(max_bytes=1 << 30, store=store)
+    states = [_test_image((64, 48))]
+    history.reset(states[0])
+    for _ in range(8):
+        op = ("resize", (rng.randint(40, 80), rng.randint(40, 80)))
+        states.append(apply_op(states[-1], op))
+        history.record(op, states[-1])
+    for _ in range(6):
+        history.undo()
+    assert sorted(history.keyframes) == [0, 4, 8]
+
+    # One byte over budget: the furthest redo keyframe goes, nothing else
+    _settle(store)
+    history.max_bytes = history.nbytes - 1
+    assert history.undo().tobytes() == states[1].tobytes()
+    assert sorted(history.keyframes) == [0, 4]
+    assert history.position == 1 and len(history.ops) == 8
+    for i in range(2, 9):
+        assert history.redo().tobytes() == states[i].tobytes()
@@ -0,0 +1,63 @@
+"""Checks for preview.py; run with python -m pytest from this folder."""
+from preview import RenderWorker
+import threading
+import time
+
+
+def _wait_idle(worker, results):
+    deadline = time.monotonic() + 10
+    while worker.busy():
+        results += worker.poll()
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+    results += worker.poll()
+
+
+def test_superseded_jobs_never_publish():
+    worker = RenderWorker()
+    started = threading.Event()
+    release = threading.Event()
+    stopped = []
+
+    def first(superseded):
+        yield "first"
+        started.set()
+        release.wait()
+        stopped.append(superseded.is_set())
+        yield "too late"
+
+    def skipped(superseded):
+        stopped.append("skipped ran")
+        yield "skipped"
+
+    def last(superseded):
+        yield "last"
+
+    worker.submit(first)
+    assert started.wait(10)
+    results = worker.poll()
+    # Queued behind the running job and replaced before it got to start
+    worker.submit(skipped)
+    generation = worker.submit(last)
+    release.set()
+    _wait_idle(worker, results)
+
+    assert [value for _, value, _ in results] == ["first", "last"]
+    assert results[-1][0] == generation
+    assert stopped == [True]
+
+
+def test_cancel_drops_uncollected_results():
+    worker = RenderWorker()
+    done = threading.Event()
+
+    def job(superseded):
+        yield 1
+        done.set()
+
+    worker.submit(job)
+    assert done.wait(10)
+    worker.cancel()
+    results = []
+    _wait_idle(worker, results)
+    assert results == []